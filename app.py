@@ -1,31 +1,79 @@
 import asyncio
+import atexit
+import bisect
+import codecs
+import csv
+import difflib
 import json
 import logging
+import math
+import mmap
 import hashlib
+import heapq
+import hmac
+import io
+import ipaddress
 import os
+import queue
+import random
+import secrets
+import re
+import socket
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
 import time
 import weakref
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import BrokenExecutor
 from datetime import datetime, timedelta
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from typing import List, Dict, Optional, Set
-from logging.handlers import RotatingFileHandler
+from html.parser import HTMLParser
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, BinaryIO, Callable, List, Dict, Optional, Set, Tuple
+from urllib.parse import urljoin, urlsplit
+from xml.etree import ElementTree
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import httpx
-import aiosmtplib
+import httpcore
 from fastapi import FastAPI, HTTPException, Request, Form
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, RedirectResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from pydantic import BaseModel, ValidationError
-import uvicorn
 from dotenv import load_dotenv
 
+import body_processing
+from body_processing import (BODY_READ_SIZE, SIMHASH_BITS, ContentDefinedChunker, TextFingerprinter,
+                             parse_ignore_selectors, process_body, simhash_distance)
+
+# 起動時間短縮のため、SMTP・プロセスプール関連は使う時点で import する
+if TYPE_CHECKING:
+    import aiosmtplib
+    from concurrent.futures import ProcessPoolExecutor
+
+# 環境変数読み込み
+load_dotenv()
+
 # ログ設定 - ローテーション付き
 log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 
+# 1回のチェック単位の記録形式（text: 従来のログ行 / json: checks.jsonl に1チェック1行）
+CHECK_LOG_FORMAT = os.getenv("CHECK_LOG_FORMAT", "text")
+CHECK_LOG_FILE = os.getenv("CHECK_LOG_FILE", "checks.jsonl")
+CHECK_LOG_SAMPLE_UNCHANGED = float(os.getenv("CHECK_LOG_SAMPLE_UNCHANGED", "0.1"))  # 変更なしの記録割合
+
+class PerCheckTextFilter(logging.Filter):
+    """json 形式では毎チェック出る定型の行（extra={'per_check': True}）をテキストログに出さない"""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        return CHECK_LOG_FORMAT != 'json' or not getattr(record, 'per_check', False)
+
 # ファイルハンドラ (最大10MB、5つまでバックアップ)
 file_handler = RotatingFileHandler(
     'watcher.log', 
@@ -39,16 +87,40 @@ file_handler.setFormatter(log_formatter)
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(log_formatter)
 
-# ルートロガー設定
+for text_handler in (file_handler, console_handler):
+    text_handler.addFilter(PerCheckTextFilter())
+
+# チェック記録（JSON Lines）
+check_logger = logging.getLogger("watcher.checks")
+check_logger.propagate = False
+if CHECK_LOG_FORMAT == 'json':
+    check_handler = RotatingFileHandler(CHECK_LOG_FILE, maxBytes=10*1024*1024, backupCount=5, encoding='utf-8')
+    check_handler.setFormatter(logging.Formatter('%(message)s'))
+    check_logger.addHandler(check_handler)
+
+# ファイル書き込み・ローテーションでイベントループを止めないよう、
+# ログはキューに積むだけにして書き込みは別スレッド（QueueListener）で行う
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+if CHECK_LOG_FORMAT == 'json':
+    check_log_queue = queue.SimpleQueue()
+    check_log_listener = QueueListener(check_log_queue, *check_logger.handlers)
+    check_logger.handlers = [QueueHandler(check_log_queue)]
+    check_log_listener.start()
+    atexit.register(check_log_listener.stop)
+
+# ルートロガー設定（書式は書き込み側のハンドラで適用するため、キューには本文だけを積む）
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
 logging.basicConfig(
     level=logging.INFO,
-    handlers=[file_handler, console_handler]
+    handlers=[queue_handler]
 )
 logger = logging.getLogger(__name__)
 
-# 環境変数読み込み
-load_dotenv()
-
 # レート制限設定
 limiter = Limiter(key_func=get_remote_address)
 app = FastAPI(title="Website Watcher", description="高信頼性サイト更新監視システム")
@@ -58,8 +130,82 @@ app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 # 簡単な認証設定
 AUTH_PASSWORD = os.getenv("AUTH_PASSWORD", "1033")
 
-# 極めてシンプルなセッション管理（環境変数ベース）
-logged_in_ips = set()  # メモリ内セッション
+# /metrics 用のトークン（Prometheus から Authorization: Bearer で送る）。未設定時はログインセッションのみ
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# 署名付きセッションCookie（サーバー側に状態を持たないため複数ワーカー・複数台で共有できる）
+# SESSION_SECRET 未設定時は初回起動時に乱数の鍵を生成し、DATA_DIR に保存して共有する
+# （パスワードから導出すると、Cookie 1つからパスワードを総当たりで検証できてしまうため）
+SESSION_SECRET_FILE = "session_secret"
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(7 * 24 * 3600)))  # 秒
+SESSION_COOKIE = "watcher_session"
+SESSION_VERSION = "v1"
+
+_session_secret: Optional[bytes] = None
+
+def load_session_secret(path: str) -> bytes:
+    """保存済みの署名鍵を読む（無ければ生成して 0600 で保存）"""
+    try:
+        with open(path, 'rb') as f:
+            secret = f.read().strip()
+        if secret:
+            return secret
+    except FileNotFoundError:
+        pass
+    # 一時ファイルに書いてからリンクし、同時に起動したワーカー間でも同じ鍵になるようにする
+    temp_file = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(secrets.token_hex(32).encode())
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(temp_file, path)
+        except FileExistsError:
+            pass
+    finally:
+        os.remove(temp_file)
+    with open(path, 'rb') as f:
+        return f.read().strip()
+
+def session_secret() -> bytes:
+    global _session_secret
+    if _session_secret is None:
+        configured = os.getenv("SESSION_SECRET")
+        _session_secret = (configured.encode() if configured
+                           else load_session_secret(os.path.join(get_data_dir(), SESSION_SECRET_FILE)))
+    return _session_secret
+
+def _session_signature(payload: str) -> str:
+    return hmac.new(session_secret(), payload.encode(), hashlib.sha256).hexdigest()
+
+def issue_session_token(now: Optional[float] = None) -> str:
+    """有効期限付きのセッショントークンを発行（形式: v1.期限.乱数.署名）"""
+    expires = int((now or time.time()) + SESSION_TTL)
+    payload = f"{SESSION_VERSION}.{expires}.{secrets.token_urlsafe(12)}"
+    return f"{payload}.{_session_signature(payload)}"
+
+def verify_session_token(token: Optional[str], now: Optional[float] = None) -> Optional[int]:
+    """署名と有効期限を検証し、有効なら期限（UNIX時刻）を返す"""
+    if not token:
+        return None
+    payload, _, signature = token.rpartition('.')
+    if not hmac.compare_digest(_session_signature(payload), signature):
+        return None
+    version, _, rest = payload.partition('.')
+    expires = rest.partition('.')[0]
+    if version != SESSION_VERSION or not expires.isdigit() or int(expires) <= (now or time.time()):
+        return None
+    return int(expires)
+
+def set_session_cookie(response, request: Request):
+    response.set_cookie(
+        SESSION_COOKIE, issue_session_token(),
+        max_age=SESSION_TTL, httponly=True, samesite="lax",
+        secure=request.url.scheme == "https" or os.getenv("ENVIRONMENT") == "production"
+    )
+    return response
 
 
 # CORS設定
@@ -73,7 +219,6 @@ app.add_middleware(
 
 # グローバル変数
 monitoring_task = None
-sites_data = []
 httpx_client = None
 cache = {}
 cache_ttl = {}
@@ -81,63 +226,346 @@ failed_sites: Set[str] = set()
 metrics = {
     'total_checks': 0,
     'failed_checks': 0,
+    'not_modified_checks': 0,
     'email_sent': 0,
     'email_failed': 0,
     'last_check_time': None,
     'uptime_start': datetime.now(),
-    'circuit_breaker_active': 0
+    'circuit_breaker_active': 0,
+    'circuit_skipped_checks': 0,
+    'check_retries': 0,
+    'retries_denied': 0,
+    'read_timeouts': 0,
+    'suppressed_changes': 0,
+    'offloaded_bodies': 0,
+    'cycle_overruns': 0
 }
 
+class Histogram:
+    """Prometheus 形式のヒストグラム"""
+    
+    def __init__(self, name: str, help_text: str, buckets: List[float]):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = sorted(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+class LabeledCounter:
+    """ラベル付きカウンター（ラベル数上限を超えた分は other に集約）"""
+    
+    def __init__(self, name: str, help_text: str, label: str, max_labels: int = 500):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.max_labels = max_labels
+        self.values: Dict[str, int] = {}
+    
+    def inc(self, label_value: str):
+        if label_value not in self.values and len(self.values) >= self.max_labels:
+            label_value = "other"
+        self.values[label_value] = self.values.get(label_value, 0) + 1
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for value, count in sorted(self.values.items()):
+            escaped = value.replace('\\', '\\\\').replace('"', '\\"')
+            lines.append(f'{self.name}{{{self.label}="{escaped}"}} {count}')
+        return lines
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+prom_fetch_latency = Histogram("watcher_fetch_duration_seconds", "サイト取得時間", LATENCY_BUCKETS)
+prom_response_size = Histogram("watcher_response_size_bytes", "取得本文サイズ",
+                               [1024, 10240, 102400, 524288, 1048576, 5242880])
+prom_cycle_duration = Histogram("watcher_check_cycle_duration_seconds", "担当中の全サイトを1周チェックする所要時間",
+                                [1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200])
+prom_schedule_lag = Histogram("watcher_schedule_lag_seconds", "予定時刻からチェック開始までの遅れ",
+                              [0.1, 1, 5, 15, 30, 60, 300, 900])
+prom_slot_wait = Histogram("watcher_slot_wait_seconds", "同時実行枠・ホスト別レート制限の待ち時間", LATENCY_BUCKETS)
+prom_smtp_latency = Histogram("watcher_smtp_send_duration_seconds", "SMTP送信時間", LATENCY_BUCKETS)
+prom_host_errors = LabeledCounter("watcher_host_errors_total", "ホスト別チェック失敗数", "host")
+
 class Site(BaseModel):
     url: str
     email: str
     name: Optional[str] = ""
+    interval: Optional[int] = None  # サイト別チェック間隔（秒）。未指定時は CHECK_INTERVAL
+    detection: Optional[str] = None  # 変更判定方式（hash / text / feed）。未指定時は CHANGE_DETECTION
+    change_threshold: Optional[int] = None  # text 方式で通知しない SimHash 距離の上限
+    ignore_pattern: Optional[str] = None  # text 方式で比較から除く正規表現
+    ignore_selectors: Optional[str] = None  # text 方式で比較から除く要素（div.ad, #clock など）
+    feed_url: Optional[str] = None  # feed 方式で読むフィード・サイトマップ（未指定時はページから検出）
 
 class CircuitBreaker:
-    """サーキットブレーカーパターン実装"""
+    """サーキットブレーカーパターン実装（非同期対応）
+
+    call には呼ぶとコルーチンを返す関数を渡す。await 中の例外も失敗として数え、
+    連続失敗が閾値に達すると OPEN になる。timeout 秒後に1件だけ試行（HALF_OPEN）し、
+    成功すれば CLOSED に戻る。is_failure が False を返す例外は失敗に数えず、
+    相手が応答したものとして成功と同じに扱う。
+    """
     
-    def __init__(self, failure_threshold: int = 5, timeout: int = 300):
+    def __init__(self, failure_threshold: int = 5, timeout: int = 300,
+                 is_failure: Callable[[Exception], bool] = lambda error: True):
         self.failure_threshold = failure_threshold
         self.timeout = timeout
+        self.is_failure = is_failure
         self.failure_count = 0
         self.last_failure_time = None
+        self.last_used = time.monotonic()
         self.state = "CLOSED"  # CLOSED, OPEN, HALF_OPEN
+        self._probing = False
+    
+    def retry_at(self) -> float:
+        """呼び出しを受け付けない間は再試行可能になる時刻（UNIX時刻）、それ以外は 0"""
+        if self.state == "OPEN":
+            return self.last_failure_time + self.timeout
+        if self.state == "HALF_OPEN" and self._probing:
+            return time.time() + min(self.timeout, SCHEDULER_MAX_SLEEP)
+        return 0.0
     
-    def call(self, func):
+    async def call(self, func):
         if self.state == "OPEN":
             if time.time() - self.last_failure_time > self.timeout:
                 self.state = "HALF_OPEN"
                 logger.info("サーキットブレーカー: HALF_OPEN状態")
             else:
                 raise Exception("サーキットブレーカー: OPEN状態")
+        probe = False  # この呼び出しが HALF_OPEN の試行か（試行中の印は試行した呼び出しだけが戻す）
+        if self.state == "HALF_OPEN":
+            if self._probing:
+                raise Exception("サーキットブレーカー: HALF_OPEN状態（試行中）")
+            self._probing = probe = True
         
         try:
-            result = func()
-            if self.state == "HALF_OPEN":
-                self.state = "CLOSED"
-                self.failure_count = 0
-                logger.info("サーキットブレーカー: CLOSED状態に復旧")
-            return result
+            result = await func()
         except Exception as e:
+            if not self.is_failure(e):
+                self._recovered(probe)
+                raise
             self.failure_count += 1
             self.last_failure_time = time.time()
             
-            if self.failure_count >= self.failure_threshold:
+            if probe or (self.state == "CLOSED" and self.failure_count >= self.failure_threshold):
                 self.state = "OPEN"
                 logger.warning(f"サーキットブレーカー: OPEN状態 ({self.failure_count}回失敗)")
                 metrics['circuit_breaker_active'] += 1
             raise e
+        finally:
+            if probe:
+                self._probing = False
+        
+        self._recovered(probe)
+        return result
+    
+    def _recovered(self, probe: bool):
+        # OPEN / HALF_OPEN の間は試行の結果だけで戻す（OPEN 前に始まった呼び出しの結果では戻さない）
+        if self.state != "CLOSED" and not probe:
+            return
+        if self.state == "HALF_OPEN":
+            self.state = "CLOSED"
+            logger.info("サーキットブレーカー: CLOSED状態に復旧")
+        self.failure_count = 0
+
+# サイトチェック用サーキットブレーカー設定
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3"))
+CIRCUIT_OPEN_SECONDS = int(os.getenv("CIRCUIT_OPEN_SECONDS", "180"))
+MAX_HOST_CIRCUITS = 10000
+CIRCUIT_IDLE_TTL = 3600  # これ以上使われていないホストの状態は破棄
+
+def is_host_failure(error: Exception) -> bool:
+    """ホストの障害とみなす失敗か（通信エラー・5xx/429）
+
+    4xx や本文サイズ超過はページ単位の問題なので、同じホストの他ページは止めない。
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, httpx.TransportError)
+
+class HostCircuitBreakers:
+    """ホスト別サーキットブレーカー（LRU・アイドル期限で件数を制限）
+
+    同じホストの複数ページは1つのブレーカーを共有するため、
+    停止中のホストは数回の失敗で全ページのチェックが止まる。
+    """
+    
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 timeout: int = CIRCUIT_OPEN_SECONDS, max_hosts: int = MAX_HOST_CIRCUITS,
+                 idle_ttl: int = CIRCUIT_IDLE_TTL):
+        self.failure_threshold = failure_threshold
+        self.timeout = timeout
+        self.max_hosts = max_hosts
+        self.idle_ttl = idle_ttl
+        self._breakers: 'OrderedDict[str, CircuitBreaker]' = OrderedDict()  # 使用順（古い順）
+    
+    @staticmethod
+    def host(url: str) -> str:
+        return urlsplit(url).hostname or ''
+    
+    def _evict(self):
+        """期限切れ・上限超過分を古い順に破棄"""
+        cutoff = time.monotonic() - self.idle_ttl
+        while self._breakers:
+            breaker = next(iter(self._breakers.values()))
+            if breaker.last_used >= cutoff and len(self._breakers) < self.max_hosts:
+                break
+            self._breakers.popitem(last=False)
+    
+    def get(self, url: str) -> CircuitBreaker:
+        host = self.host(url)
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            self._evict()
+            breaker = self._breakers[host] = CircuitBreaker(self.failure_threshold, self.timeout, is_host_failure)
+        else:
+            self._breakers.move_to_end(host)
+        breaker.last_used = time.monotonic()
+        return breaker
+    
+    def retry_at(self, url: str) -> float:
+        """チェックを見送るべき場合は再試行可能時刻、それ以外は 0（使用順は変えない）"""
+        breaker = self._breakers.get(self.host(url))
+        return breaker.retry_at() if breaker else 0.0
+    
+    def stats(self) -> Dict:
+        states = {"CLOSED": 0, "OPEN": 0, "HALF_OPEN": 0}
+        for breaker in self._breakers.values():
+            states[breaker.state] += 1
+        return {"hosts": len(self._breakers), "open": states["OPEN"], "half_open": states["HALF_OPEN"],
+                "closed": states["CLOSED"]}
+    
+    def tripped(self) -> List[Dict]:
+        """CLOSED 以外のホスト一覧"""
+        return [{
+            "host": host,
+            "state": breaker.state,
+            "failure_count": breaker.failure_count,
+            "retry_at": datetime.fromtimestamp(breaker.last_failure_time + breaker.timeout).isoformat()
+        } for host, breaker in self._breakers.items() if breaker.state != "CLOSED"]
+
+# メール送信設定
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+SMTP_IDLE_TIMEOUT = int(os.getenv("SMTP_IDLE_TIMEOUT", "60"))  # これ以上アイドルの接続は破棄
+SMTP_NOOP_AFTER = 10  # アイドル時間がこれを超えた接続は NOOP で生存確認
+EMAIL_DIGEST_WINDOW = int(os.getenv("EMAIL_DIGEST_WINDOW", "0"))  # 0 で即時送信
+NOTIFIER_WORKERS = int(os.getenv("NOTIFIER_WORKERS", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_BATCH_SIZE = 50  # ダイジェスト1通にまとめる最大件数
+OUTBOX_CLAIM_TIMEOUT = 600  # 送信中の行をこの秒数で再送対象に戻す
+SMTP_PROBE_TIMEOUT = float(os.getenv("SMTP_PROBE_TIMEOUT", "15"))  # 起動時の接続確認の上限（秒）
+SMTP_PROBE_RETRY_INTERVAL = int(os.getenv("SMTP_PROBE_RETRY_INTERVAL", "300"))  # 失敗時の再確認間隔（秒）
+
+class SMTPConnectionPool:
+    """認証済みSMTPセッションの再利用プール"""
+    
+    def __init__(self, service: 'AsyncEmailService', size: int = SMTP_POOL_SIZE):
+        self.service = service
+        self._semaphore = asyncio.Semaphore(size)
+        self._idle: List[Tuple['aiosmtplib.SMTP', float]] = []
+    
+    async def _connect(self) -> 'aiosmtplib.SMTP':
+        import aiosmtplib
+        smtp = aiosmtplib.SMTP(
+            hostname=self.service.smtp_server,
+            port=self.service.smtp_port,
+            start_tls=self.service.start_tls,
+            username=self.service.username,
+            password=self.service.password,
+            timeout=30
+        )
+        try:
+            await smtp.connect()  # 接続・STARTTLS・ログインまで実行
+        except BaseException:
+            smtp.close()  # 取り消し時もソケットを残さない
+            raise
+        return smtp
+    
+    async def _close(self, smtp: 'aiosmtplib.SMTP'):
+        try:
+            if smtp.is_connected:
+                await smtp.quit()
+        except Exception:
+            smtp.close()
+    
+    async def _acquire(self) -> 'aiosmtplib.SMTP':
+        while self._idle:
+            smtp, released_at = self._idle.pop()
+            idle = time.monotonic() - released_at
+            if not smtp.is_connected or idle > SMTP_IDLE_TIMEOUT:
+                await self._close(smtp)
+                continue
+            if idle > SMTP_NOOP_AFTER:
+                try:
+                    await smtp.noop()
+                except Exception:
+                    await self._close(smtp)
+                    continue
+                except BaseException:
+                    smtp.close()
+                    raise
+            return smtp
+        return await self._connect()
+    
+    @asynccontextmanager
+    async def connection(self):
+        """接続を借りる（失敗・取り消しされた接続は返却せず破棄）
+
+        CancelledError は Exception ではないため finally で処理する。
+        取り消し中は quit を待たずに閉じ、枠はセマフォの解放で必ず返す。
+        """
+        async with self._semaphore:
+            smtp = await self._acquire()
+            ok = False
+            try:
+                yield smtp
+                ok = True
+            except Exception:
+                await self._close(smtp)
+                raise
+            finally:
+                if ok:
+                    self._idle.append((smtp, time.monotonic()))
+                elif smtp.is_connected:
+                    smtp.close()
+    
+    async def close(self):
+        while self._idle:
+            smtp, _ = self._idle.pop()
+            await self._close(smtp)
 
 class AsyncEmailService:
-    """非同期メール送信サービス（サーキットブレーカー付き）"""
+    """非同期メール送信サービス（サーキットブレーカー・接続プール付き）"""
     
     def __init__(self):
         self.smtp_server = os.getenv("SMTP_SERVER", "smtp.gmail.com")
         self.smtp_port = int(os.getenv("SMTP_PORT", "587"))
+        self.start_tls = os.getenv("SMTP_STARTTLS", "true").lower() == "true"  # ローカルのリレー等では false
         self.username = os.getenv("SMTP_USERNAME", "")
         self.password = os.getenv("SMTP_PASSWORD", "")
         self.from_email = os.getenv("FROM_EMAIL", "")
         self.circuit_breaker = CircuitBreaker(failure_threshold=5, timeout=300)
+        self.pool = SMTPConnectionPool(self)
+        # 接続確認の結果（pending / ok / failed）。/api/health で返す
+        self.smtp_status = {'state': 'pending', 'checked_at': None, 'error': None}
     
     async def send_email(self, to_email: str, subject: str, body: str) -> bool:
         """非同期メール送信"""
@@ -149,6 +577,7 @@ class AsyncEmailService:
         for attempt in range(max_retries):
             try:
                 await self._send_with_circuit_breaker(to_email, subject, body)
+                self._set_status('ok')
                 logger.info(f"✅ メール送信成功: {to_email}")
                 metrics['email_sent'] += 1
                 return True
@@ -163,84 +592,1819 @@ class AsyncEmailService:
     
     async def _send_with_circuit_breaker(self, to_email: str, subject: str, body: str):
         """サーキットブレーカー付きメール送信"""
-        def send_func():
-            return asyncio.create_task(self._send_email_core(to_email, subject, body))
-        
-        task = self.circuit_breaker.call(send_func)
-        await task
+        await self.circuit_breaker.call(lambda: self._send_email_core(to_email, subject, body))
     
     async def _send_email_core(self, to_email: str, subject: str, body: str):
-        """コアメール送信機能"""
+        """コアメール送信機能（プールした接続を再利用）"""
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
         msg = MIMEMultipart()
         msg['From'] = self.from_email
         msg['To'] = to_email
         msg['Subject'] = subject
         msg.attach(MIMEText(body, 'plain', 'utf-8'))
         
-        await aiosmtplib.send(
-            msg,
-            hostname=self.smtp_server,
-            port=self.smtp_port,
-            start_tls=True,
-            username=self.username,
-            password=self.password,
-            timeout=30
-        )
+        started = time.monotonic()
+        async with self.pool.connection() as smtp:
+            await smtp.send_message(msg)
+        prom_smtp_latency.observe(time.monotonic() - started)
+    
+    async def close(self):
+        await self.pool.close()
     
     async def test_connection(self) -> bool:
-        """SMTP接続テスト"""
+        """SMTP接続テスト（結果は smtp_status に記録）"""
         try:
             logger.info("Gmail SMTP接続テスト開始...")
-            async with aiosmtplib.SMTP(hostname=self.smtp_server, port=self.smtp_port) as server:
-                await server.starttls()
-                await server.login(self.username, self.password)
+            await asyncio.wait_for(self._login_probe(), SMTP_PROBE_TIMEOUT)
             logger.info("✅ Gmail SMTP接続成功")
+            self._set_status('ok')
             return True
         except Exception as e:
-            logger.error(f"❌ Gmail SMTP接続失敗: {e}")
+            error = str(e) or type(e).__name__  # タイムアウト時はメッセージが空
+            logger.error(f"❌ Gmail SMTP接続失敗: {error}")
+            self._set_status('failed', error)
+            return False
+    
+    async def _login_probe(self):
+        import aiosmtplib
+        async with aiosmtplib.SMTP(hostname=self.smtp_server, port=self.smtp_port) as server:
+            if self.start_tls:
+                await server.starttls()
+            await server.login(self.username, self.password)
+    
+    def _set_status(self, state: str, error: Optional[str] = None):
+        self.smtp_status = {'state': state, 'checked_at': datetime.now().isoformat(), 'error': error}
+    
+    async def probe_until_ready(self):
+        """起動をブロックしないよう、接続確認をバックグラウンドで成功するまで繰り返す"""
+        while not await self.test_connection():
+            logger.warning(f"⚠️ メール設定に問題があります（{SMTP_PROBE_RETRY_INTERVAL}秒後に再確認）")
+            await asyncio.sleep(SMTP_PROBE_RETRY_INTERVAL)
+        logger.info("✅ メール設定確認完了")
+
+# DNSキャッシュ設定
+DNS_CACHE_ENABLED = os.getenv("DNS_CACHE_ENABLED", "true").lower() == "true"
+DNS_NAMESERVERS = os.getenv("DNS_NAMESERVERS", "")  # 例: 127.0.0.1:5353,1.1.1.1（未指定時は /etc/resolv.conf）
+DNS_HOSTS_FILE = os.getenv("DNS_HOSTS_FILE", "/etc/hosts")
+DNS_NEGATIVE_TTL = int(os.getenv("DNS_NEGATIVE_TTL", "60"))  # 存在しないホストの記憶秒数
+DNS_MIN_TTL = 30
+DNS_MAX_TTL = 3600
+DNS_FALLBACK_TTL = 300  # システムリゾルバで解決した場合（TTL不明）
+DNS_QUERY_TIMEOUT = 2.0
+MAX_DNS_CACHE = 10000
+DNS_TYPE_A, DNS_TYPE_CNAME, DNS_TYPE_SOA, DNS_TYPE_AAAA = 1, 5, 6, 28
+
+class DNSDatagramProtocol(asyncio.DatagramProtocol):
+    """DNS応答を1件だけ受け取るUDPプロトコル"""
+    
+    def __init__(self, query_id: int, future: asyncio.Future):
+        self.query_id = query_id
+        self.future = future
+    
+    def datagram_received(self, data: bytes, addr):
+        if len(data) >= 2 and struct.unpack_from('!H', data)[0] == self.query_id and not self.future.done():
+            self.future.set_result(data)
+    
+    def error_received(self, exc: Exception):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+class CachingResolver:
+    """TTLを守る非同期DNSキャッシュ（存在しないホストも一定時間記憶）
+
+    ネームサーバーへ直接UDPで問い合わせてTTLを取得する。ネームサーバーが
+    使えない場合はシステムリゾルバ（スレッド実行）に切り替える。hosts ファイルの
+    エントリは常に優先する。同じホストへの同時問い合わせは1回にまとめる。
+    """
+    
+    def __init__(self, nameservers: str = DNS_NAMESERVERS, hosts_file: str = DNS_HOSTS_FILE,
+                 max_entries: int = MAX_DNS_CACHE):
+        self.nameservers = self._parse_nameservers(nameservers)
+        self.hosts = self._load_hosts(hosts_file)
+        self.max_entries = max_entries
+        self._cache: 'OrderedDict[str, Tuple[List[str], float]]' = OrderedDict()  # ホスト → (アドレス, 期限)
+        self._pending: Dict[str, asyncio.Task] = {}
+        self.stats_counts = {"hits": 0, "misses": 0, "negative_hits": 0, "fallbacks": 0}
+    
+    @staticmethod
+    def _parse_nameservers(nameservers: str) -> List[Tuple[str, int]]:
+        entries = [entry.strip() for entry in nameservers.split(',') if entry.strip()]
+        if not entries:
+            try:
+                with open('/etc/resolv.conf', 'r', encoding='utf-8') as f:
+                    entries = [line.split()[1] for line in f if line.startswith('nameserver') and len(line.split()) > 1]
+            except OSError:
+                return []
+        servers = []
+        for entry in entries:
+            host, _, port = entry.rpartition(':') if entry.count(':') == 1 else (entry, '', '')
+            servers.append((host, int(port)) if port else (entry, 53))
+        return servers
+    
+    @staticmethod
+    def _load_hosts(hosts_file: str) -> Dict[str, List[str]]:
+        hosts: Dict[str, List[str]] = {}
+        try:
+            with open(hosts_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    fields = line.split('#', 1)[0].split()
+                    for name in fields[1:]:
+                        hosts.setdefault(name.lower(), []).append(fields[0])
+        except OSError:
+            pass
+        return hosts
+    
+    async def resolve(self, host: str) -> List[str]:
+        """ホスト名をアドレス一覧に解決（解決できない場合は例外）"""
+        host = host.lower().rstrip('.')
+        try:
+            ipaddress.ip_address(host)
+            return [host]
+        except ValueError:
+            pass
+        if host in self.hosts:
+            return self.hosts[host]
+        
+        entry = self._cache.get(host)
+        if entry and entry[1] > time.monotonic():
+            self._cache.move_to_end(host)
+            if not entry[0]:
+                self.stats_counts["negative_hits"] += 1
+                raise Exception(f"DNS解決失敗（キャッシュ）: {host}")
+            self.stats_counts["hits"] += 1
+            return entry[0]
+        
+        task = self._pending.get(host)
+        if task is None:
+            self.stats_counts["misses"] += 1
+            task = self._pending[host] = asyncio.create_task(self._lookup(host))
+            task.add_done_callback(lambda _: self._pending.pop(host, None))
+        addresses = await asyncio.shield(task)
+        if not addresses:
+            raise Exception(f"DNS解決失敗: {host}")
+        return addresses
+    
+    def _store(self, host: str, addresses: List[str], ttl: float):
+        if host not in self._cache and len(self._cache) >= self.max_entries:
+            self._cache.popitem(last=False)
+        self._cache[host] = (addresses, time.monotonic() + ttl)
+        self._cache.move_to_end(host)
+    
+    async def _lookup(self, host: str) -> List[str]:
+        """ネームサーバー → システムリゾルバの順で解決（空リストは存在しないホスト）"""
+        if self.nameservers:
+            try:
+                addresses, ttl, nxdomain = await self._query_nameservers(host, DNS_TYPE_A)
+                if not addresses and not nxdomain:
+                    addresses, ttl, _ = await self._query_nameservers(host, DNS_TYPE_AAAA)
+                if addresses:
+                    self._store(host, addresses, min(max(ttl, DNS_MIN_TTL), DNS_MAX_TTL))
+                else:
+                    self._store(host, [], min(ttl, DNS_NEGATIVE_TTL))
+                return addresses
+            except Exception as e:
+                logger.debug(f"DNS問い合わせ失敗のためシステムリゾルバを使用: {host} - {e}")
+        
+        self.stats_counts["fallbacks"] += 1
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            if e.errno in (socket.EAI_NONAME, getattr(socket, 'EAI_NODATA', socket.EAI_NONAME)):
+                self._store(host, [], DNS_NEGATIVE_TTL)
+                return []
+            raise
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        self._store(host, addresses, DNS_FALLBACK_TTL)
+        return addresses
+    
+    async def _query_nameservers(self, host: str, qtype: int) -> Tuple[List[str], int, bool]:
+        last_error: Optional[Exception] = None
+        for server in self.nameservers:
+            try:
+                return await self._query(server, host, qtype)
+            except Exception as e:
+                last_error = e
+        raise last_error or Exception("ネームサーバー未設定")
+    
+    async def _query(self, server: Tuple[str, int], host: str, qtype: int) -> Tuple[List[str], int, bool]:
+        """1回のUDP問い合わせ。戻り値は (アドレス, TTL, NXDOMAINか)。アドレスが無い場合のTTLは否定応答TTL"""
+        query_id = random.getrandbits(16)
+        qname = b''.join(bytes([len(label)]) + label for label in host.encode('idna').split(b'.') if label) + b'\0'
+        payload = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + qname + struct.pack('!HH', qtype, 1)
+        
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: DNSDatagramProtocol(query_id, future), remote_addr=server)
+        try:
+            transport.sendto(payload)
+            data = await asyncio.wait_for(future, DNS_QUERY_TIMEOUT)
+        finally:
+            transport.close()
+        return self._parse_response(data, qtype)
+    
+    @staticmethod
+    def _skip_name(data: bytes, offset: int) -> int:
+        while True:
+            length = data[offset]
+            if length == 0:
+                return offset + 1
+            if length & 0xC0 == 0xC0:
+                return offset + 2  # 圧縮ポインタ
+            offset += length + 1
+    
+    def _parse_response(self, data: bytes, qtype: int) -> Tuple[List[str], int, bool]:
+        _, flags, qdcount, ancount, nscount, _ = struct.unpack_from('!HHHHHH', data)
+        if flags & 0x0200:
+            raise Exception("DNS応答が切り詰められています")
+        rcode = flags & 0x000F
+        if rcode not in (0, 3):  # NOERROR / NXDOMAIN 以外（SERVFAIL 等）は記憶しない
+            raise Exception(f"DNSエラー応答 (rcode={rcode})")
+        
+        offset = 12
+        for _ in range(qdcount):
+            offset = self._skip_name(data, offset) + 4
+        
+        addresses = []
+        ttl = DNS_MAX_TTL
+        negative_ttl = DNS_NEGATIVE_TTL
+        for index in range(ancount + nscount):
+            offset = self._skip_name(data, offset)
+            rtype, _, record_ttl, rdlength = struct.unpack_from('!HHIH', data, offset)
+            offset += 10
+            rdata = data[offset:offset + rdlength]
+            offset += rdlength
+            if index < ancount:
+                if rtype == qtype:
+                    family = socket.AF_INET if qtype == DNS_TYPE_A else socket.AF_INET6
+                    addresses.append(socket.inet_ntop(family, rdata))
+                    ttl = min(ttl, record_ttl)
+                elif rtype == DNS_TYPE_CNAME:
+                    ttl = min(ttl, record_ttl)
+            elif rtype == DNS_TYPE_SOA and rdlength >= 4:
+                # 否定応答のTTLは SOA の TTL と MINIMUM の小さい方
+                negative_ttl = min(record_ttl, struct.unpack('!I', rdata[-4:])[0])
+        
+        return addresses, ttl if addresses else negative_ttl, rcode == 3
+    
+    def stats(self) -> Dict:
+        return {"entries": len(self._cache), **self.stats_counts}
+
+class CachingNetworkBackend(httpcore.AsyncNetworkBackend):
+    """CachingResolver で名前解決してから接続する httpcore ネットワークバックエンド
+
+    TLS の SNI・証明書検証は httpcore が元のホスト名で行うため、接続先だけを差し替える。
+    """
+    
+    def __init__(self, resolver: CachingResolver, backend: Optional[httpcore.AsyncNetworkBackend] = None):
+        self.resolver = resolver
+        self.backend = backend or httpcore.AnyIOBackend()
+    
+    async def connect_tcp(self, host: str, port: int, timeout: Optional[float] = None,
+                          local_address: Optional[str] = None, socket_options=None):
+        try:
+            addresses = await self.resolver.resolve(host)
+        except Exception as e:
+            raise httpcore.ConnectError(str(e))
+        
+        last_error: Optional[Exception] = None
+        for address in addresses[:2]:  # 先頭2件まで順に試す
+            try:
+                return await self.backend.connect_tcp(address, port, timeout, local_address, socket_options)
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                last_error = e
+        raise last_error
+    
+    async def connect_unix_socket(self, path: str, timeout: Optional[float] = None, socket_options=None):
+        return await self.backend.connect_unix_socket(path, timeout, socket_options)
+    
+    async def sleep(self, seconds: float):
+        await self.backend.sleep(seconds)
+
+# コンテンツハッシュ設定
+HASH_ALGORITHM = os.getenv("HASH_ALGORITHM", "md5")  # md5 / blake2b など hashlib 対応のもの
+MAX_BODY_SIZE = int(os.getenv("MAX_BODY_SIZE", str(5 * 1024 * 1024)))  # 5MB
+
+def new_content_hasher():
+    """本文ハッシュ用のインクリメンタルハッシュ生成"""
+    if HASH_ALGORITHM == 'blake2b':
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.new(HASH_ALGORITHM)
+
+# 未対応のアルゴリズムで全チェックが失敗し続けないよう起動時に確認
+try:
+    new_content_hasher().hexdigest()
+except (ValueError, TypeError):
+    raise ValueError(f"HASH_ALGORITHM={HASH_ALGORITHM!r} は使用できません"
+                     "（md5 / sha256 / blake2b など hashlib で固定長のダイジェストを返すものを指定してください）") from None
+
+# 類似度による変更判定設定
+CHANGE_DETECTION = os.getenv("CHANGE_DETECTION", "hash")  # hash: 本文ハッシュ / text: 表示テキストの SimHash / feed: フィード・サイトマップ
+SIMHASH_THRESHOLD = int(os.getenv("SIMHASH_THRESHOLD", "3"))  # 通知しないハミング距離の上限（0〜64ビット）
+DETECTION_MODES = ('hash', 'text', 'feed')
+def site_detection_mode(site: 'SiteRecord') -> str:
+    return site.detection or CHANGE_DETECTION
+
+def site_change_threshold(site: 'SiteRecord') -> int:
+    return SIMHASH_THRESHOLD if site.change_threshold is None else site.change_threshold
+
+# 本文処理のプロセスプール設定
+# チャンク分割・表示テキスト抽出は純 Python で CPU を使うため、大きな本文は別プロセスで処理する
+OFFLOAD_THRESHOLD = int(os.getenv("OFFLOAD_THRESHOLD", str(256 * 1024)))  # これを超える本文を別プロセスへ（バイト）
+OFFLOAD_WORKERS = int(os.getenv("OFFLOAD_WORKERS", str(os.cpu_count() or 1)))  # 0 で常にイベントループ上で処理
+OFFLOAD_MAX_PENDING = int(os.getenv("OFFLOAD_MAX_PENDING", str(max(OFFLOAD_WORKERS, 1) * 2)))  # 処理待ちの上限
+
+class BodySpool:
+    """変更の有無が分かるまで本文を一時保存（OFFLOAD_THRESHOLD まではメモリ、超えたら一時ファイル）"""
+    
+    def __init__(self, threshold: int = OFFLOAD_THRESHOLD):
+        self.threshold = threshold
+        self.buffer = bytearray()
+        self.file = None
+        self.size = 0
+    
+    @property
+    def path(self) -> Optional[str]:
+        return self.file.name if self.file else None
+    
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self.file is None and self.size > self.threshold:
+            self.file = tempfile.NamedTemporaryFile(prefix='watcher-body-', delete=False)
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+        if self.file:
+            self.file.write(data)
+        else:
+            self.buffer += data
+    
+    def chunks(self):
+        """保存した本文を BODY_READ_SIZE ずつ返す（メモリ上の本文はコピーせずに切り出す）"""
+        if self.file is None:
+            view = memoryview(self.buffer)
+            for offset in range(0, len(view), BODY_READ_SIZE):
+                yield view[offset:offset + BODY_READ_SIZE]
+            return
+        self.file.flush()
+        with open(self.path, 'rb') as f:
+            while True:
+                data = f.read(BODY_READ_SIZE)
+                if not data:
+                    break
+                yield data
+    
+    def close(self):
+        self.buffer = bytearray()
+        if self.file:
+            self.file.close()
+            try:
+                os.remove(self.file.name)
+            except OSError:
+                pass
+            self.file = None
+
+class BodyProcessor:
+    """大きな本文の処理をプロセスプールに回す（小さな本文はイベントループ上でそのまま処理）"""
+    
+    def __init__(self, workers: int = OFFLOAD_WORKERS, max_pending: int = OFFLOAD_MAX_PENDING):
+        self.workers = workers
+        self.executor: Optional['ProcessPoolExecutor'] = None
+        # 処理待ちを制限し、溜まったら本文の受け取り側を待たせる
+        self.pending = asyncio.Semaphore(max_pending)
+    
+    def should_offload(self, spool: BodySpool) -> bool:
+        return self.workers > 0 and spool.path is not None
+    
+    async def process(self, spool: BodySpool, encoding: Optional[str],
+                      snapshot: Optional['SnapshotWriter'], fingerprint: Optional[TextFingerprinter]):
+        """本文をチャンク化・SimHash 計算する"""
+        if snapshot:
+            snapshot.encoding = encoding
+        if fingerprint:
+            fingerprint.encoding = encoding
+        if self.should_offload(spool):
+            await self.run(spool, snapshot, fingerprint)
+            return
+        for data in spool.chunks():
+            if snapshot:
+                snapshot.feed(data)
+            if fingerprint:
+                fingerprint.feed(data)
+        if snapshot:
+            snapshot.finish()
+        if fingerprint:
+            fingerprint.finish()
+    
+    async def run(self, spool: BodySpool, snapshot: Optional['SnapshotWriter'], fingerprint: Optional[TextFingerprinter]):
+        # 本文は一時ファイルのパスだけを渡し、ワーカーはファイルから読む
+        spool.file.flush()
+        async with self.pending:
+            if self.executor is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # スレッド（ログ出力など）を持つプロセスの fork を避け、spawn で起動
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            try:
+                lengths, text_fingerprint = await self._submit(
+                    spool.path, snapshot is not None, fingerprint is not None,
+                    fingerprint.encoding if fingerprint else None,
+                    fingerprint.ignore_pattern if fingerprint else None,
+                    fingerprint.ignore_selectors if fingerprint else None)
+            except BrokenExecutor:
+                # ワーカーが異常終了したプールは使えないため次回作り直す
+                self.executor = None
+                raise
+        metrics['offloaded_bodies'] += 1
+        if snapshot:
+            with open(spool.path, 'rb') as f:
+                snapshot.add_chunks(f, lengths)
+        if fingerprint:
+            fingerprint.fingerprint = text_fingerprint
+    
+    def _submit(self, *args) -> asyncio.Future:
+        # spawn したワーカーは起動時に親の __main__（app.py / start.py）を読み込み直し、
+        # ログ・DB・FastAPI の初期化まで実行してしまう。ワーカーを起動しうる投入の間だけ
+        # __main__ を副作用のない body_processing に差し替えて、ワーカーにはそれだけを読ませる
+        main_module = sys.modules['__main__']
+        sys.modules['__main__'] = body_processing
+        try:
+            return asyncio.get_running_loop().run_in_executor(self.executor, process_body, *args)
+        finally:
+            sys.modules['__main__'] = main_module
+    
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+# フィード・サイトマップ監視設定
+FEED_MAX_BYTES = int(os.getenv("FEED_MAX_BYTES", str(50 * 1024 * 1024)))  # 展開後のサイズ上限（サイトマップ仕様の上限）
+FEED_DISCOVERY_MAX_BYTES = 256 * 1024  # フィード検出時に読むページ先頭のサイズ
+FEED_REPORT_LIMIT = 20  # 通知に載せる新着エントリ数
+FEED_DIGEST_SIZE = 8  # エントリキーのハッシュ長（バイト）
+FEED_REDISCOVERY_FAILURES = 3  # 検出したフィードの取得がこの回数続けて失敗したら検出し直す
+FEED_LINK_TYPES = ('application/rss+xml', 'application/atom+xml', 'application/feed+xml')
+# エントリ要素 → 親要素（RSS 2.0 / RSS 1.0 / Atom / サイトマップ / サイトマップインデックス）
+FEED_ENTRY_PARENTS = {'item': ('channel', 'RDF'), 'entry': ('feed',), 'url': ('urlset',), 'sitemap': ('sitemapindex',)}
+
+def xml_local_name(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+class FeedLinkFinder(HTMLParser):
+    """ページの <head> から RSS / Atom フィードの URL を探す"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.feed_url: Optional[str] = None
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'link' and self.feed_url is None:
+            attrs = dict(attrs)
+            rel = (attrs.get('rel') or '').lower().split()
+            if 'alternate' in rel and (attrs.get('type') or '').lower() in FEED_LINK_TYPES and attrs.get('href'):
+                self.feed_url = attrs['href']
+                self.done = True
+        elif tag == 'body':
+            self.done = True
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.done = True
+
+class FeedEntryParser:
+    """RSS / Atom / サイトマップをストリーミングで解析し、エントリのキーを集める
+
+    エントリは RSS の guid（無ければ link / title）、Atom の id、サイトマップの
+    loc と lastmod の組をキーとし、そのハッシュ（FEED_DIGEST_SIZE バイト）だけを保持する。
+    解析済みの要素は木から外すため、大きなサイトマップでもメモリに溜まらない。
+    known に無いキーは新着として最大 FEED_REPORT_LIMIT 件まで表示用の文字列を残す。
+    """
+
+    def __init__(self, known: Set[bytes]):
+        self.known = known
+        self.entries: Set[bytes] = set()
+        self.new_entries: List[str] = []
+        self.new_count = 0
+        self._parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        self._stack: List[ElementTree.Element] = []
+
+    def feed(self, data: bytes):
+        self._parser.feed(data)
+        self._drain()
+
+    def close(self):
+        self._parser.close()
+        self._drain()
+
+    def _drain(self):
+        for event, element in self._parser.read_events():
+            if event == 'start':
+                self._stack.append(element)
+                continue
+            self._stack.pop()
+            parents = FEED_ENTRY_PARENTS.get(xml_local_name(element.tag))
+            if parents and self._stack and xml_local_name(self._stack[-1].tag) in parents:
+                self._add(element)
+                element.clear()
+                self._stack[-1].remove(element)
+
+    def _add(self, element: ElementTree.Element):
+        fields: Dict[str, str] = {}
+        for child in element:
+            name = xml_local_name(child.tag)
+            if name == 'link' and child.get('href'):
+                # Atom は rel="alternate"（省略時も alternate）のリンクを使う
+                if child.get('rel', 'alternate') == 'alternate':
+                    fields.setdefault('link', child.get('href'))
+            elif name not in fields:
+                fields[name] = (child.text or '').strip()
+        loc = fields.get('loc')
+        if loc:
+            key = f"{loc}|{fields.get('lastmod', '')}"
+            label = f"{loc} ({fields['lastmod']})" if fields.get('lastmod') else loc
+        else:
+            key = fields.get('guid') or fields.get('id') or fields.get('link') or fields.get('title')
+            if not key:
+                return
+            link = fields.get('link', '')
+            label = f"{fields['title']}\n  {link}" if fields.get('title') else link or key
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=FEED_DIGEST_SIZE).digest()
+        if digest in self.entries:
+            return
+        self.entries.add(digest)
+        if digest not in self.known:
+            self.new_count += 1
+            if len(self.new_entries) < FEED_REPORT_LIMIT:
+                self.new_entries.append(label)
+
+def pack_feed_entries(entries: Set[bytes]) -> bytes:
+    return b''.join(sorted(entries))
+
+def unpack_feed_entries(blob: Optional[bytes]) -> Set[bytes]:
+    blob = blob or b''
+    return {blob[i:i + FEED_DIGEST_SIZE] for i in range(0, len(blob), FEED_DIGEST_SIZE)}
+
+# タイムアウト・リトライ設定
+DEFAULT_CHECK_TIMEOUT = 10.0  # 応答時間の統計が無いホストのタイムアウト（秒）
+MIN_CONNECT_TIMEOUT = 1.0
+MAX_CONNECT_TIMEOUT = 10.0
+MIN_READ_TIMEOUT = 2.0
+MAX_READ_TIMEOUT = float(os.getenv("MAX_READ_TIMEOUT", "30"))
+TIMEOUT_TAIL_FACTOR = 3.0  # 直近 p95 の何倍まで待つか
+LATENCY_EWMA_ALPHA = 0.2
+LATENCY_WINDOW = 32  # p95 計算に使う直近サンプル数
+LATENCY_MIN_SAMPLES = 3
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))  # チェック数に対するリトライの上限割合
+RETRY_BUDGET_MIN = int(os.getenv("RETRY_BUDGET_MIN", "5"))  # 周期ごとに必ず許可するリトライ数
+
+class HostLatency:
+    """ホスト別の応答時間（EWMA と直近サンプル）"""
+    
+    __slots__ = ('ewma', 'samples')
+    
+    def __init__(self):
+        self.ewma = 0.0
+        self.samples = deque(maxlen=LATENCY_WINDOW)
+    
+    def observe(self, seconds: float):
+        self.ewma = seconds if not self.samples else self.ewma + LATENCY_EWMA_ALPHA * (seconds - self.ewma)
+        self.samples.append(seconds)
+    
+    def tail(self) -> float:
+        """直近サンプルの p95"""
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+class AdaptiveTimeouts:
+    """ホスト別の応答時間統計から接続・読み取りタイムアウトを決定
+
+    遅いが正常なホストは待ち時間を延ばし、速いホストが詰まった場合は早めに諦める。
+    統計が少ないホストは従来どおり DEFAULT_CHECK_TIMEOUT を使う。
+    """
+    
+    def __init__(self, max_hosts: int = 10000):
+        self.max_hosts = max_hosts
+        self._hosts: 'OrderedDict[str, HostLatency]' = OrderedDict()
+    
+    def observe(self, url: str, seconds: float):
+        host = urlsplit(url).hostname or ''
+        stats = self._hosts.get(host)
+        if stats is None:
+            if len(self._hosts) >= self.max_hosts:
+                self._hosts.popitem(last=False)
+            stats = self._hosts[host] = HostLatency()
+        else:
+            self._hosts.move_to_end(host)
+        stats.observe(seconds)
+    
+    def timeout(self, url: str) -> httpx.Timeout:
+        stats = self._hosts.get(urlsplit(url).hostname or '')
+        if stats is None or len(stats.samples) < LATENCY_MIN_SAMPLES:
+            return httpx.Timeout(DEFAULT_CHECK_TIMEOUT)
+        tail = max(stats.tail(), stats.ewma)
+        connect = min(max(tail * 2, MIN_CONNECT_TIMEOUT), MAX_CONNECT_TIMEOUT)
+        read = min(max(tail * TIMEOUT_TAIL_FACTOR, MIN_READ_TIMEOUT), MAX_READ_TIMEOUT)
+        return httpx.Timeout(read, connect=connect)
+    
+    def stats(self) -> Dict:
+        return {"hosts": len(self._hosts)}
+
+class RetryBudget:
+    """周期ごとのリトライ予算
+
+    初回リクエストごとに ratio 分の予算が貯まり、リトライ1回で1を消費する。
+    障害時にリトライが負荷を増幅しないよう、周期ごとに最小値へ戻す。
+    """
+    
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, minimum: int = RETRY_BUDGET_MIN,
+                 period: Optional[float] = None):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.period = period or CHECK_INTERVAL
+        self.reset()
+    
+    def reset(self):
+        self.requests = 0
+        self.retries = 0
+        self.period_start = time.monotonic()
+    
+    def _roll(self):
+        if time.monotonic() - self.period_start >= self.period:
+            self.reset()
+    
+    def deposit(self):
+        self._roll()
+        self.requests += 1
+    
+    def withdraw(self) -> bool:
+        self._roll()
+        if self.retries + 1 > self.minimum + self.requests * self.ratio:
+            metrics['retries_denied'] += 1
             return False
+        self.retries += 1
+        metrics['check_retries'] += 1
+        return True
+    
+    def stats(self) -> Dict:
+        return {"requests": self.requests, "retries": self.retries,
+                "remaining": max(0, int(self.minimum + self.requests * self.ratio) - self.retries),
+                "period_seconds": self.period}
+
+def is_retryable(error: Exception) -> bool:
+    """一時的な失敗か（タイムアウト・通信エラー・5xx/429）"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError))
 
 class AsyncSiteChecker:
     """非同期サイトチェッククラス"""
     
     def __init__(self, client: httpx.AsyncClient):
         self.client = client
-        self.site_circuits = {}  # サイト別サーキットブレーカー
+        self.circuits = host_circuits  # ホスト別サーキットブレーカー
+        self.timeouts = adaptive_timeouts
+        self.retry_budget = retry_budget
+        self.limiter = check_limiter  # ホスト別レート・同時実行枠
     
-    async def get_site_hash(self, url: str, timeout: int = 10) -> Optional[str]:
-        """非同期サイトハッシュ取得"""
-        if url not in self.site_circuits:
-            self.site_circuits[url] = CircuitBreaker(failure_threshold=3, timeout=180)
-        
+    async def get_site_hash(self, url: str, timeout: Optional[httpx.Timeout] = None,
+                            cached: Optional['SiteRecord'] = None,
+                            snapshot: Optional['SnapshotWriter'] = None,
+                            fingerprint: Optional[TextFingerprinter] = None,
+                            sample: Optional['CheckSample'] = None) -> Optional[Tuple[str, Dict[str, str]]]:
+        """非同期サイトハッシュ取得（条件付きGET対応）
+
+        cached には前回チェック時のサイト情報（hash / etag / last_modified）を渡す。
+        戻り値は (ハッシュ, 検証子) のタプル。304応答時は前回ハッシュを返す。
+        snapshot を渡すと本文をチャンク化してスナップショット用に取り込む。
+        fingerprint を渡すと表示テキストの SimHash も計算する。
+        どちらも304応答時と本文のハッシュが前回と同じ場合は処理しない。
+        sample を渡すと取得時間と本文サイズを書き込む。
+        timeout 未指定時はホスト別の応答時間から決める。
+        """
         try:
-            def check_func():
-                return self._check_site_core(url, timeout)
-            
-            content_hash = await self.site_circuits[url].call(check_func)
-            logger.info(f"✅ サイトチェック成功: {url} (hash: {content_hash[:8]}...)")
-            return content_hash
+            content_hash, validators = await self.circuits.get(url).call(
+                lambda: self._fetch_with_retry(url, timeout, cached, snapshot, fingerprint, sample))
+            logger.info(f"✅ サイトチェック成功: {url} (hash: {content_hash[:8]}...)", extra={'per_check': True})
+            return content_hash, validators
             
         except Exception as e:
             logger.error(f"❌ サイトチェック失敗: {url} - {e}")
             metrics['failed_checks'] += 1
+            prom_host_errors.inc(urlsplit(url).hostname or '')
             return None
     
-    async def _check_site_core(self, url: str, timeout: int) -> str:
+    async def _fetch_with_retry(self, url: str, timeout: Optional[httpx.Timeout], cached: Optional['SiteRecord'],
+                                snapshot: Optional['SnapshotWriter'],
+                                fingerprint: Optional[TextFingerprinter] = None,
+                                sample: Optional['CheckSample'] = None) -> Tuple[str, Dict[str, str]]:
+        """一時的な失敗はリトライ予算の範囲で1回だけ再試行
+
+        ホスト別レートと同時実行枠は試行ごとに確保し、リトライ前の待機中は他サイトに譲る。
+        """
+        self.retry_budget.deposit()
+        for attempt in range(2):
+            attempt_timeout = timeout or self.timeouts.timeout(url)
+            try:
+                async with self.limiter.slot(url):
+                    return await self._check_site_core(url, attempt_timeout, cached, snapshot, fingerprint, sample)
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                # タイムアウトは応答時間ではないため統計には入れず件数だけ数える
+                # （入れると止まったホストのタイムアウトが上限まで伸びたままになる）
+                if isinstance(e, httpx.ReadTimeout):
+                    metrics['read_timeouts'] += 1
+                if attempt or not is_retryable(e) or not self.retry_budget.withdraw():
+                    raise
+                logger.info(f"🔁 リトライ: {url} - {e}")
+                if snapshot:
+                    snapshot.reset()
+                if fingerprint:
+                    fingerprint.reset()
+                await asyncio.sleep(random.uniform(0.5, 1.0))
+    
+    async def _check_site_core(self, url: str, timeout: httpx.Timeout, cached: Optional['SiteRecord'],
+                               snapshot: Optional['SnapshotWriter'] = None,
+                               fingerprint: Optional[TextFingerprinter] = None,
+                               sample: Optional['CheckSample'] = None) -> Tuple[str, Dict[str, str]]:
         """コアサイトチェック機能"""
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
         
-        response = await self.client.get(url, timeout=timeout, headers=headers)
-        response.raise_for_status()
+        # 前回ハッシュがある場合のみ条件付きGET（初回・ハッシュ方式変更時は必ず本文を取得）
+        last_hash = cached.hash if cached and cached.hash_algo == HASH_ALGORITHM else ''
+        if last_hash:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
         
-        content_hash = hashlib.md5(response.text.encode('utf-8')).hexdigest()
+        # スナップショット・SimHash 用の本文は、ハッシュで変更の有無が分かるまで一時保存する
+        spool = BodySpool() if snapshot or fingerprint else None
+        try:
+            started = time.monotonic()
+            async with self.client.stream('GET', url, timeout=timeout, headers=headers) as response:
+                self.timeouts.observe(url, time.monotonic() - started)  # 応答ヘッダーまでの時間
+                if response.status_code == 304 and last_hash:
+                    prom_fetch_latency.observe(time.monotonic() - started)
+                    prom_response_size.observe(0)
+                    if sample:
+                        sample.latency = time.monotonic() - started
+                        sample.size = 0
+                    # 変更なし: 本文は読まずに前回の検証子を引き継ぐ
+                    validators = {
+                        'etag': response.headers.get('ETag', cached.etag or ''),
+                        'last_modified': response.headers.get('Last-Modified', cached.last_modified or '')
+                    }
+                    metrics['total_checks'] += 1
+                    metrics['not_modified_checks'] += 1
+                    return last_hash, validators
+                
+                response.raise_for_status()
+                
+                content_length = response.headers.get('Content-Length', '')
+                if content_length.isdigit() and int(content_length) > MAX_BODY_SIZE:
+                    raise ValueError(f"本文サイズ上限超過 ({content_length} > {MAX_BODY_SIZE} bytes)")
+                
+                # 本文はチャンク単位でハッシュ
+                hasher = new_content_hasher()
+                body_size = 0
+                encoding = response.charset_encoding
+                async for chunk in response.aiter_bytes():
+                    body_size += len(chunk)
+                    if body_size > MAX_BODY_SIZE:
+                        raise ValueError(f"本文サイズ上限超過 (> {MAX_BODY_SIZE} bytes)")
+                    hasher.update(chunk)
+                    if spool:
+                        spool.write(chunk)
+                
+                validators = {
+                    'etag': response.headers.get('ETag', ''),
+                    'last_modified': response.headers.get('Last-Modified', '')
+                }
+            
+            # 接続を返してから本文を処理。前回と同じ本文ならチャンク分割・SimHash は不要
+            # （text 方式に切り替えた直後は基準の SimHash を作るため計算する）
+            content_hash = hasher.hexdigest()
+            if spool and (content_hash != last_hash or (fingerprint and not cached.simhash)):
+                await body_processor.process(spool, encoding, snapshot, fingerprint)
+        finally:
+            if spool:
+                spool.close()
+        
+        prom_fetch_latency.observe(time.monotonic() - started)
+        prom_response_size.observe(body_size)
+        if sample:
+            sample.latency = time.monotonic() - started
+            sample.size = body_size
         metrics['total_checks'] += 1
-        return content_hash
+        return content_hash, validators
+    
+    async def get_feed_entries(self, feed_url: str, cached: 'SiteRecord', known: Set[bytes],
+                               sample: Optional['CheckSample'] = None) -> Optional[Tuple[Optional[FeedEntryParser], Dict[str, str]]]:
+        """フィード・サイトマップのエントリ取得（条件付きGET対応）
+
+        戻り値は (解析結果, 検証子) のタプル。304応答時の解析結果は None。
+        """
+        try:
+            return await self.circuits.get(feed_url).call(lambda: self._fetch_feed(feed_url, cached, known, sample))
+        except Exception as e:
+            logger.error(f"❌ フィード取得失敗: {feed_url} - {e}")
+            metrics['failed_checks'] += 1
+            prom_host_errors.inc(urlsplit(feed_url).hostname or '')
+            return None
+    
+    async def _fetch_feed(self, feed_url: str, cached: 'SiteRecord', known: Set[bytes],
+                          sample: Optional['CheckSample'] = None) -> Tuple[Optional[FeedEntryParser], Dict[str, str]]:
+        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+        if known:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+        
+        started = time.monotonic()
+        async with self.client.stream('GET', feed_url, timeout=self.timeouts.timeout(feed_url), headers=headers) as response:
+            self.timeouts.observe(feed_url, time.monotonic() - started)
+            validators = {
+                'etag': response.headers.get('ETag', ''),
+                'last_modified': response.headers.get('Last-Modified', '')
+            }
+            metrics['total_checks'] += 1
+            if response.status_code == 304 and known:
+                metrics['not_modified_checks'] += 1
+                prom_fetch_latency.observe(time.monotonic() - started)
+                prom_response_size.observe(0)
+                if sample:
+                    sample.latency = time.monotonic() - started
+                validators = {'etag': validators['etag'] or cached.etag or '',
+                              'last_modified': validators['last_modified'] or cached.last_modified or ''}
+                return None, validators
+            response.raise_for_status()
+            
+            # sitemap.xml.gz は Content-Encoding なしの gzip として配信されることが多い
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            gzipped = not response.headers.get('Content-Encoding') and (
+                urlsplit(feed_url).path.endswith('.gz') or content_type in ('application/gzip', 'application/x-gzip'))
+            decompressor = zlib.decompressobj(wbits=31) if gzipped else None
+            
+            parser = FeedEntryParser(known)
+            body_size = 0
+            received = 0
+            async for chunk in response.aiter_bytes():
+                received += len(chunk)
+                if decompressor:
+                    chunk = decompressor.decompress(chunk, FEED_MAX_BYTES - body_size + 1)
+                body_size += len(chunk)
+                if body_size > FEED_MAX_BYTES:
+                    raise ValueError(f"フィードサイズ上限超過 (> {FEED_MAX_BYTES} bytes)")
+                parser.feed(chunk)
+            parser.close()
+        
+        prom_fetch_latency.observe(time.monotonic() - started)
+        prom_response_size.observe(received)
+        if sample:
+            sample.latency = time.monotonic() - started
+            sample.size = received
+        return parser, validators
+    
+    async def discover_feed(self, url: str) -> str:
+        """ページのフィード URL を探す（<link rel="alternate">、robots.txt の Sitemap、/sitemap.xml の順）"""
+        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+        timeout = self.timeouts.timeout(url)
+        finder = FeedLinkFinder()
+        async with self.client.stream('GET', url, timeout=timeout, headers=headers) as response:
+            base_url = str(response.url)
+            # ページがエラーでもサイトマップは取れることがあるため続ける（接続エラーは失敗とする）
+            if response.is_success:
+                decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+                received = 0
+                async for chunk in response.aiter_bytes():
+                    received += len(chunk)
+                    finder.feed(decoder.decode(chunk))
+                    if finder.done or received > FEED_DISCOVERY_MAX_BYTES:
+                        break
+        if finder.feed_url:
+            return urljoin(base_url, finder.feed_url)
+        
+        parts = urlsplit(base_url)
+        root = f"{parts.scheme}://{parts.netloc}"
+        try:
+            response = await self.client.get(f"{root}/robots.txt", timeout=timeout, headers=headers)
+            if response.status_code == 200:
+                for line in response.text.splitlines():
+                    field, _, value = line.partition(':')
+                    if field.strip().lower() == 'sitemap' and value.strip():
+                        return value.strip()
+        except httpx.HTTPError:
+            pass
+        return f"{root}/sitemap.xml"
+
+# 同時実行制御設定
+MAX_CONCURRENT_CHECKS = int(os.getenv("MAX_CONCURRENT_CHECKS", "10"))
+HOST_RATE_PER_SECOND = float(os.getenv("HOST_RATE_PER_SECOND", "1"))  # ホスト別の平均リクエスト数/秒（0 以下で無制限）
+HOST_BURST = max(int(os.getenv("HOST_BURST", "2")), 1)  # ホスト別の連続リクエスト上限
+MAX_HOST_BUCKETS = 10000
+
+class HostTokenBucket:
+    """ホスト別トークンバケット（予約方式）"""
+    
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def reserve(self) -> float:
+        """トークンを1つ予約し、利用可能になるまでの待機秒数を返す"""
+        self._refill(time.monotonic())
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+    
+    def try_acquire(self) -> bool:
+        """待たずに取れる場合だけトークンを1つ消費"""
+        self._refill(time.monotonic())
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+    
+    def is_idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.burst
+
+class HostAwareLimiter:
+    """全体の同時実行数とホスト別トークンバケットによる流量制御
+
+    ホスト別の待機はグローバル枠を確保する前に行うため、
+    混雑したホスト宛てのチェックが他ホストの枠を塞がない。
+    """
+    
+    def __init__(self, max_concurrency: int = MAX_CONCURRENT_CHECKS,
+                 host_rate: float = HOST_RATE_PER_SECOND, host_burst: int = HOST_BURST):
+        self.max_concurrency = max_concurrency
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.buckets: Dict[str, HostTokenBucket] = {}
+    
+    def _bucket(self, host: str) -> HostTokenBucket:
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            if len(self.buckets) >= MAX_HOST_BUCKETS:
+                # 満タンまで回復したバケットは状態を持たないので破棄
+                self.buckets = {h: b for h, b in self.buckets.items() if not b.is_idle()}
+            bucket = self.buckets[host] = HostTokenBucket(self.host_rate, self.host_burst)
+        return bucket
+    
+    @asynccontextmanager
+    async def slot(self, url: str):
+        """ホスト別レート制限 → グローバル同時実行枠の順で確保"""
+        started = time.monotonic()
+        wait = self._bucket(urlsplit(url).hostname or '').reserve() if self.host_rate > 0 else 0.0
+        if wait > 0:
+            await asyncio.sleep(wait)
+        async with self.semaphore:
+            prom_slot_wait.observe(time.monotonic() - started)
+            yield
+    
+    def try_acquire(self, url: str) -> bool:
+        """ホスト別レートに空きがあれば枠を使う（待機しない）"""
+        if self.host_rate <= 0:
+            return True
+        return self._bucket(urlsplit(url).hostname or '').try_acquire()
+    
+    def pool_limits(self, sites: Tuple['SiteRecord', ...]) -> httpx.Limits:
+        """ホスト構成からコネクションプールの大きさを決定
+
+        キープアライブが効くのは複数ページを持つホストだけなので、
+        その数×バースト上限を保持数とする。
+        """
+        pages_per_host: Dict[str, int] = {}
+        for site in sites:
+            host = urlsplit(site.url).hostname or ''
+            pages_per_host[host] = pages_per_host.get(host, 0) + 1
+        shared_hosts = sum(1 for count in pages_per_host.values() if count > 1)
+        keepalive = max(1, min(self.max_concurrency, shared_hosts * self.host_burst))
+        return httpx.Limits(max_keepalive_connections=keepalive, max_connections=self.max_concurrency)
+
+# スケジューラ設定
+CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "300"))
+MIN_CHECK_INTERVAL = int(os.getenv("MIN_CHECK_INTERVAL", "60"))
+CHECK_JITTER = float(os.getenv("CHECK_JITTER", "0.1"))  # 間隔に対する揺らぎの割合
+ADAPTIVE_MIN_FACTOR = float(os.getenv("ADAPTIVE_MIN_FACTOR", "0.25"))
+ADAPTIVE_MAX_FACTOR = float(os.getenv("ADAPTIVE_MAX_FACTOR", "8"))
+SCHEDULER_MAX_SLEEP = 30  # サイト追加を拾うための最大待機秒数
+SCHEDULE_SAVE_INTERVAL = 10  # 次回チェック時刻の保存間隔（秒）
+STARTUP_DELAY = float(os.getenv("STARTUP_DELAY", "5"))  # 起動直後にチェックを始めない秒数
+STARTUP_RAMP = float(os.getenv("STARTUP_RAMP", "60"))  # 期限切れのサイトを分散させる秒数
+
+# 登録時に決まる項目とチェック結果としてサイトに書き戻す項目
+SITE_CONFIG_KEYS = ('url', 'email', 'name', 'created_at', 'interval',
+                    'detection', 'change_threshold', 'ignore_pattern', 'ignore_selectors', 'feed_url')
+SITE_STATE_KEYS = ('hash', 'hash_algo', 'simhash', 'feed_source', 'etag', 'last_modified', 'last_check',
+                   'current_interval', 'next_check')
+# 通知を送ったワーカー（担当とは限らない）がDBへ直接書く項目。DBを正とする
+SITE_NOTIFY_KEYS = ('last_notified',)
+
+class SiteRecord:
+    """監視サイト1件（__slots__ によりサイトごとの dict を持たない）"""
+    
+    __slots__ = ('id',) + SITE_CONFIG_KEYS + SITE_STATE_KEYS + SITE_NOTIFY_KEYS
+    
+    def __init__(self, id: Optional[int] = None, **fields):
+        self.id = id
+        for key in SITE_CONFIG_KEYS + SITE_STATE_KEYS + SITE_NOTIFY_KEYS:
+            setattr(self, key, fields.get(key))
+    
+    def update(self, values: Dict):
+        for key, value in values.items():
+            setattr(self, key, value)
+    
+    def to_dict(self) -> Dict:
+        """API応答・DB登録用（未設定の項目は含めない）"""
+        values = {key: getattr(self, key) for key in self.__slots__}
+        return {key: value for key, value in values.items() if value is not None}
+
+class SiteRegistry:
+    """ID・URL索引付きのサイト一覧
+
+    一覧はコピーオンライトのスナップショット（タプル）として渡し、追加・削除の
+    たびに作り直す。チェック中に保持しているスナップショットは API からの
+    追加・削除の影響を受けず、レコード自体は同じオブジェクトを共有する。
+    """
+    
+    def __init__(self):
+        self._by_id: Dict[int, SiteRecord] = {}
+        self._by_url: Dict[str, SiteRecord] = {}
+        self._snapshot: Optional[Tuple[SiteRecord, ...]] = None
+        self.version = 0  # 追加・削除のたびに増える
+    
+    def __len__(self) -> int:
+        return len(self._by_id)
+    
+    def get(self, site_id: int) -> Optional[SiteRecord]:
+        return self._by_id.get(site_id)
+    
+    def by_url(self, url: str) -> Optional[SiteRecord]:
+        return self._by_url.get(url)
+    
+    def contains(self, site: SiteRecord) -> bool:
+        """登録中のサイトか（チェック中に削除されたレコードは False）"""
+        return self._by_id.get(site.id) is site
+    
+    def snapshot(self) -> Tuple[SiteRecord, ...]:
+        """現時点のサイト一覧（変更されるまで同じタプルを返す）"""
+        if self._snapshot is None:
+            self._snapshot = tuple(self._by_id.values())
+        return self._snapshot
+    
+    def _changed(self):
+        self._snapshot = None
+        self.version += 1
+    
+    def add(self, site: SiteRecord):
+        self._by_id[site.id] = site
+        self._by_url[site.url] = site
+        self._changed()
+    
+    def remove(self, site_id: int) -> Optional[SiteRecord]:
+        site = self._by_id.pop(site_id, None)
+        if site is not None:
+            del self._by_url[site.url]
+            self._changed()
+        return site
+    
+    def load(self, rows: List[Dict],
+             keep_state: Callable[[SiteRecord], bool] = lambda site: False) -> List[SiteRecord]:
+        """DBの行で一覧を置き換え、DBから消えていたサイトを返す
+
+        既存のサイトは同じレコードのまま項目を更新する。keep_state が True を
+        返すサイトはメモリ上のチェック結果を正とし、登録項目だけを更新する。
+        通知時刻は他ワーカーが書くため常にDBの値を取り込む。
+        """
+        by_id = {}
+        for row in rows:
+            site = self._by_id.get(row['id'])
+            if site is None:
+                site = SiteRecord(**row)
+            else:
+                keys = SITE_CONFIG_KEYS if keep_state(site) else SITE_CONFIG_KEYS + SITE_STATE_KEYS
+                for key in keys + SITE_NOTIFY_KEYS:
+                    setattr(site, key, row.get(key))
+            by_id[site.id] = site
+        
+        removed = [site for site_id, site in self._by_id.items() if site_id not in by_id]
+        changed = by_id.keys() != self._by_id.keys()
+        self._by_id = by_id
+        self._by_url = {site.url: site for site in by_id.values()}
+        if changed:
+            self._changed()
+        return removed
+
+class CheckScheduler:
+    """次回チェック時刻の最小ヒープによるサイト別スケジューラ
+
+    サイトごとに間隔を持ち、変更が多いサイトは間隔を短く、
+    変更のないサイトは長くする。次回時刻は next_check としてサイトに保存する。
+    """
+    
+    def __init__(self, base_interval: int = CHECK_INTERVAL, jitter: float = CHECK_JITTER):
+        self.base_interval = base_interval
+        self.jitter = jitter
+        self.in_flight: Set[str] = set()
+        self.dirty: Dict[str, SiteRecord] = {}  # 未保存のチェック結果（URL → サイト）
+        self._heap: List[Tuple[float, int, str]] = []
+        self._due: Dict[str, float] = {}  # URL → 有効な次回時刻（ヒープ内の古いエントリ判定用）
+        self._sites: Dict[str, SiteRecord] = {}
+        self._seq = 0
+        self._synced = None
+        self._wakeup = asyncio.Event()
+        self._ramp_start = 0.0
+        self._ramp = 0.0
+        # 1周（その時点で担当中の全サイトを1回ずつチェックし終えるまで）の計測
+        self._round_started: Optional[float] = None
+        self._round_pending: Set[str] = set()
+    
+    def site_interval(self, site: SiteRecord) -> float:
+        """サイトの基本間隔"""
+        return float(site.interval or self.base_interval)
+    
+    def current_interval(self, site: SiteRecord) -> float:
+        """変更頻度で調整済みの現在間隔"""
+        return float(site.current_interval or self.site_interval(site))
+    
+    def _with_jitter(self, interval: float) -> float:
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+    
+    def schedule(self, site: SiteRecord, due: float):
+        """サイトを指定時刻にスケジュール"""
+        url = site.url
+        self._seq += 1
+        self._due[url] = due
+        heapq.heappush(self._heap, (due, self._seq, url))
+        site.next_check = datetime.fromtimestamp(due).isoformat()
+    
+    def start_warmup(self, now: float, delay: float = STARTUP_DELAY, ramp: float = STARTUP_RAMP):
+        """起動直後の一斉チェックを避ける（期限切れのサイトを delay 秒後から ramp 秒に分散）"""
+        self._ramp_start = now + delay
+        self._ramp = ramp
+    
+    def _initial_due(self, site: SiteRecord, now: float) -> float:
+        """保存済みの次回時刻を復元（無ければ1周期内に分散）"""
+        due = None
+        if site.next_check:
+            try:
+                due = datetime.fromisoformat(site.next_check).timestamp()
+            except ValueError:
+                pass
+        if due is None:
+            if not site.hash:
+                due = now + random.uniform(0, min(self.site_interval(site), SCHEDULER_MAX_SLEEP))
+            else:
+                due = now + random.uniform(0, self.current_interval(site))
+        # ウォームアップ中は開始時刻より前の分を順に立ち上げる
+        if due < self._ramp_start:
+            due = self._ramp_start + random.uniform(0, self._ramp)
+        return due
+    
+    def sync(self, registry: SiteRegistry, now: float, shard: Optional['ShardLease'] = None):
+        """サイト一覧の追加・削除をヒープに反映（shard 指定時は担当サイトのみ）"""
+        key = (registry.version, shard.version if shard else None)
+        if key == self._synced:
+            return
+        
+        self._sites = {site.url: site for site in registry.snapshot() if shard is None or shard.owns(site.url)}
+        for url, site in self._sites.items():
+            if url not in self._due and url not in self.in_flight:
+                self.schedule(site, self._initial_due(site, now))
+        for url in [url for url in self._due if url not in self._sites]:
+            del self._due[url]
+        self._round_pending &= self._sites.keys()
+        if self._round_started is None and self._sites:
+            self._start_round(now)
+        self._synced = key
+    
+    def _start_round(self, now: float):
+        self._round_started = now
+        self._round_pending = set(self._sites)
+    
+    def _finish_check(self, url: str, now: float):
+        """1周分のサイトがすべてチェックされたら所要時間を記録して次の周に入る"""
+        self._round_pending.discard(url)
+        if self._round_started is not None and not self._round_pending:
+            prom_cycle_duration.observe(now - self._round_started)
+            self._start_round(now)
+    
+    def _discard_stale(self):
+        while self._heap and self._due.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+    
+    def pop_due(self, now: float, limit: int,
+                blocked: Optional[Callable[[SiteRecord], float]] = None) -> List[SiteRecord]:
+        """期限到来サイトを最大 limit 件取り出す
+
+        blocked がサイトの再試行可能時刻を返した場合（ホスト停止中など）は
+        取り出さずにその時刻へ再スケジュールする。
+        """
+        due_sites = []
+        while len(due_sites) < limit:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            due, _, url = heapq.heappop(self._heap)
+            del self._due[url]
+            site = self._sites[url]
+            retry_at = blocked(site) if blocked else 0
+            if retry_at > now:
+                metrics['circuit_skipped_checks'] += 1
+                self.schedule(site, retry_at + random.uniform(0, self.jitter * self.current_interval(site)))
+                continue
+            self.in_flight.add(url)
+            due_sites.append(site)
+            
+            # 1周期以上遅れたら超過としてカウント
+            lag = now - due
+            prom_schedule_lag.observe(lag)
+            if lag > self.current_interval(site):
+                metrics['cycle_overruns'] += 1
+        return due_sites
+    
+    def upcoming(self, now: float, window: float, limit: int) -> List[SiteRecord]:
+        """window 秒以内に期限が来るサイト（取り出さない）"""
+        entries = heapq.nsmallest(limit * 2, self._heap)  # 古いエントリを含むため多めに見る
+        return [self._sites[url] for due, _, url in entries
+                if now < due <= now + window and self._due.get(url) == due][:limit]
+    
+    def seconds_until_next(self, now: float) -> float:
+        self._discard_stale()
+        if not self._heap:
+            return SCHEDULER_MAX_SLEEP
+        return min(max(self._heap[0][0] - now, 0), SCHEDULER_MAX_SLEEP)
+    
+    def complete(self, site: SiteRecord, status: str, now: Optional[float] = None):
+        """チェック結果から間隔を調整して再スケジュール"""
+        now = now or time.time()
+        url = site.url
+        self.in_flight.discard(url)
+        
+        # チェック中に削除・担当替えされたサイトは再スケジュールしない
+        if self._sites.get(url) is not site:
+            return
+        self._finish_check(url, now)
+        
+        base = self.site_interval(site)
+        interval = self.current_interval(site)
+        if status == 'changed':
+            interval *= 0.5
+        elif status == 'unchanged':
+            interval *= 1.2
+        elif status == 'initial':
+            interval = base
+        interval = min(max(interval, base * ADAPTIVE_MIN_FACTOR, MIN_CHECK_INTERVAL), base * ADAPTIVE_MAX_FACTOR)
+        
+        site.current_interval = round(interval, 1)
+        self.schedule(site, now + self._with_jitter(interval))
+        self.dirty[url] = site
+        self.wake()
+    
+    def claim(self, url: str):
+        """期限前のサイトを手動チェック用に実行中へ移す（ヒープ内の予定は無効化）"""
+        self._due.pop(url, None)
+        self.in_flight.add(url)
+    
+    def site(self, url: str) -> Optional[SiteRecord]:
+        """URLから担当中のサイトを取得"""
+        return self._sites.get(url)
+    
+    def has_local_state(self, site: SiteRecord) -> bool:
+        """メモリ上のチェック結果がDBより新しい可能性があるか"""
+        return site.url in self._sites or site.url in self.dirty or site.url in self.in_flight
+    
+    def take_dirty(self) -> List[SiteRecord]:
+        """未保存のサイトを取り出す"""
+        sites = list(self.dirty.values())
+        self.dirty = {}
+        return sites
+    
+    def wake(self):
+        self._wakeup.set()
+    
+    async def wait(self, timeout: float):
+        """次の期限・チェック完了・サイト追加のいずれかまで待機"""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._wakeup.clear()
+    
+    def stats(self) -> Dict:
+        now = time.time()
+        return {
+            "scheduled": len(self._due),
+            "in_flight": len(self.in_flight),
+            "overdue": sum(1 for due in self._due.values() if due <= now)
+        }
+
+# スナップショット設定
+SNAPSHOTS_ENABLED = os.getenv("SNAPSHOTS_ENABLED", "true").lower() == "true"
+SNAPSHOT_MAX_VERSIONS = int(os.getenv("SNAPSHOT_MAX_VERSIONS", "10"))
+SNAPSHOT_MAX_AGE_DAYS = int(os.getenv("SNAPSHOT_MAX_AGE_DAYS", "30"))
+SNAPSHOT_GC_THRESHOLD = 50  # 削除バージョン数がこれを超えたら未参照チャンクを回収
+SNAPSHOT_DIFF_MAX_LINES = 60
+
+class SnapshotWriter:
+    """チェック中の本文をチャンク化し、未保存チャンクだけを保持する"""
+    
+    def __init__(self, store: 'SnapshotStore'):
+        self.store = store
+        self.reset()
+    
+    def reset(self):
+        """取り込み途中の本文を破棄（リトライ時）"""
+        self.chunker = ContentDefinedChunker()
+        self.chunks: List[str] = []
+        self.new_chunks: Dict[str, bytes] = {}
+        self.size = 0
+        self.encoding: Optional[str] = None
+    
+    def feed(self, data: bytes):
+        for chunk in self.chunker.feed(data):
+            self._add(chunk)
+    
+    def finish(self):
+        for chunk in self.chunker.finish():
+            self._add(chunk)
+    
+    def add_chunks(self, source: BinaryIO, lengths: List[int]):
+        """別プロセスで求めたチャンク境界で本文（一時ファイル）を取り込む"""
+        for length in lengths:
+            self._add(source.read(length))
+    
+    def _add(self, chunk: bytes):
+        chunk_id = hashlib.blake2b(chunk, digest_size=16).hexdigest()
+        self.chunks.append(chunk_id)
+        self.size += len(chunk)
+        if chunk_id not in self.new_chunks and not self.store.touch_chunk(chunk_id):
+            self.new_chunks[chunk_id] = chunk
+
+class SnapshotStore:
+    """重複排除チャンクストアによるページスナップショット履歴
+
+    各チャンクは内容ハッシュをキーに圧縮して1度だけ保存し、
+    各バージョンはチャンク参照のリストとして保存する。
+    """
+    
+    def __init__(self, root: Optional[str] = None):
+        self._root = root
+        self._gc_pending = 0
+        # GC（別スレッド）の判定・削除と、保存済みチャンクの更新時刻の更新を排他する
+        self._chunk_lock = threading.Lock()
+    
+    @property
+    def root(self) -> str:
+        if not self._root:
+            self._root = os.path.join(get_data_dir(), 'snapshots')
+        return self._root
+    
+    def writer(self) -> SnapshotWriter:
+        return SnapshotWriter(self)
+    
+    @staticmethod
+    def site_key(url: str) -> str:
+        return hashlib.blake2b(url.encode('utf-8'), digest_size=8).hexdigest()
+    
+    def _chunk_path(self, chunk_id: str) -> str:
+        return os.path.join(self.root, 'chunks', chunk_id[:2], chunk_id)
+    
+    def _versions_path(self, url: str) -> str:
+        return os.path.join(self.root, 'versions', self.site_key(url) + '.json')
+    
+    def has_chunk(self, chunk_id: str) -> bool:
+        return os.path.exists(self._chunk_path(chunk_id))
+    
+    def touch_chunk(self, chunk_id: str) -> bool:
+        """保存済みなら更新時刻を更新して True（参照前のチャンクを GC の回収対象から外す）"""
+        with self._chunk_lock:
+            try:
+                os.utime(self._chunk_path(chunk_id))
+                return True
+            except FileNotFoundError:
+                return False
+    
+    def _write_chunk(self, chunk_id: str, data: bytes):
+        path = self._chunk_path(chunk_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_file = path + '.tmp'
+        with open(temp_file, 'wb') as f:
+            f.write(zlib.compress(data, 6))
+        os.replace(temp_file, path)
+    
+    def _read_chunk(self, chunk_id: str) -> bytes:
+        with open(self._chunk_path(chunk_id), 'rb') as f:
+            return zlib.decompress(f.read())
+    
+    def load_versions(self, url: str) -> List[Dict]:
+        path = self._versions_path(url)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('versions', [])
+    
+    def _save_versions(self, url: str, versions: List[Dict]):
+        path = self._versions_path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_file = path + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump({'url': url, 'versions': versions}, f)
+        os.replace(temp_file, path)
+    
+    def record(self, url: str, writer: SnapshotWriter, content_hash: str) -> List[Dict]:
+        """新バージョンを保存し、保持上限を適用したバージョン一覧を返す"""
+        versions = self.load_versions(url)
+        if versions and versions[-1]['hash'] == content_hash:
+            return versions  # 通知失敗後の再検知など、同一内容は記録しない
+        
+        for chunk_id in writer.chunks:
+            if chunk_id in writer.new_chunks:
+                if not self.has_chunk(chunk_id):
+                    self._write_chunk(chunk_id, writer.new_chunks[chunk_id])
+            elif not self.touch_chunk(chunk_id):
+                raise ValueError(f"チャンク欠損: {chunk_id}")
+        
+        versions.append({
+            'timestamp': datetime.now().isoformat(),
+            'hash': content_hash,
+            'size': writer.size,
+            'encoding': writer.encoding,
+            'chunks': writer.chunks
+        })
+        
+        # 保持上限（件数・期間）
+        cutoff = (datetime.now() - timedelta(days=SNAPSHOT_MAX_AGE_DAYS)).isoformat()
+        kept = [v for v in versions[-SNAPSHOT_MAX_VERSIONS:] if v['timestamp'] >= cutoff]
+        self._gc_pending += len(versions) - len(kept)
+        
+        self._save_versions(url, kept)
+        return kept
+    
+    def read_version(self, version: Dict) -> bytes:
+        return b''.join(self._read_chunk(chunk_id) for chunk_id in version['chunks'])
+    
+    def _decode(self, version: Dict) -> List[str]:
+        text = self.read_version(version).decode(version.get('encoding') or 'utf-8', errors='replace')
+        return [line[:200] for line in text.splitlines()]
+    
+    def diff(self, url: str, from_index: int = -2, to_index: int = -1,
+             max_lines: Optional[int] = None) -> str:
+        """2バージョン間の unified diff"""
+        versions = self.load_versions(url)
+        try:
+            old, new = versions[from_index], versions[to_index]
+        except IndexError:
+            return ""
+        
+        lines = list(difflib.unified_diff(
+            self._decode(old), self._decode(new),
+            fromfile=old['timestamp'], tofile=new['timestamp'], lineterm='', n=1
+        ))
+        if max_lines and len(lines) > max_lines:
+            lines = lines[:max_lines] + [f"... (他 {len(lines) - max_lines} 行)"]
+        return "\n".join(lines)
+    
+    def forget(self, url: str):
+        """サイト削除時に履歴を削除"""
+        path = self._versions_path(url)
+        if os.path.exists(path):
+            os.remove(path)
+            self._gc_pending += SNAPSHOT_MAX_VERSIONS
+    
+    def gc_due(self) -> bool:
+        return self._gc_pending >= SNAPSHOT_GC_THRESHOLD
+    
+    def collect_garbage(self, min_age: int = 3600) -> int:
+        """未参照チャンクを回収（書き込み中の競合を避けるため古いものだけ）
+
+        取得中のチェックが見つけたチャンクは touch_chunk で更新時刻が新しくなるため、
+        参照一覧を読んだ後に保存されたバージョンのチャンクも回収しない。
+        """
+        self._gc_pending = 0
+        version_dir = os.path.join(self.root, 'versions')
+        chunk_dir = os.path.join(self.root, 'chunks')
+        if not os.path.isdir(chunk_dir):
+            return 0
+        
+        referenced = set()
+        if os.path.isdir(version_dir):
+            for name in os.listdir(version_dir):
+                if not name.endswith('.json'):
+                    continue
+                with open(os.path.join(version_dir, name), 'r', encoding='utf-8') as f:
+                    for version in json.load(f).get('versions', []):
+                        referenced.update(version['chunks'])
+        
+        removed = 0
+        cutoff = time.time() - min_age
+        for prefix in os.listdir(chunk_dir):
+            prefix_dir = os.path.join(chunk_dir, prefix)
+            for chunk_id in os.listdir(prefix_dir):
+                if chunk_id in referenced:
+                    continue
+                path = os.path.join(prefix_dir, chunk_id)
+                with self._chunk_lock:
+                    try:
+                        if os.path.getmtime(path) < cutoff:
+                            os.remove(path)
+                            removed += 1
+                    except FileNotFoundError:
+                        pass
+        
+        logger.info(f"🧹 スナップショットGC: {removed}チャンク削除")
+        return removed
+
+# チェック履歴設定
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "true").lower() == "true"
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", "30"))
+# 1件が表す時間枠（秒）。同じ枠内のチェックは1件にまとめるため、チェック間隔によらず HISTORY_DAYS 日分を保持する
+HISTORY_RESOLUTION = max(int(os.getenv("HISTORY_RESOLUTION", "900")), 1)
+# サイトごとの保持件数（1件14バイト）。既定の30日・900秒で2880件≒40KB、1万サイトで約400MB
+HISTORY_CAPACITY = HISTORY_DAYS * 86400 // HISTORY_RESOLUTION
+HISTORY_HEADER = struct.Struct('<4sIQ')  # マジック / 容量 / 書き込み総数
+# 枠の開始時刻（UNIX秒） / 応答時間の平均・最小・最大（ms） / チェック数 / 失敗数 / 変更数 / 平均本文サイズ（対数符号）
+HISTORY_RECORD = struct.Struct('<IHHHBBBB')
+HISTORY_MAGIC = b'WWH3'
+HISTORY_OLD_MAGICS = (b'WWH1', b'WWH2')  # 旧形式のファイルは作り直す
+HISTORY_STATUSES = ('initial', 'changed', 'unchanged', 'failed')
+HISTORY_MAX_BUCKETS = 500
+
+def encode_history_size(size: int) -> int:
+    """本文サイズを1バイトに符号化（2倍ごとに8段階、誤差は約9%）"""
+    if size <= 0:
+        return 0
+    return min(255, max(1, math.ceil(math.log2(size + 1) * 8)))
+
+def decode_history_size(code: int) -> int:
+    return round(2 ** (code / 8)) - 1 if code else 0
+
+class CheckSample:
+    """1回のチェックの計測値（取得処理が書き込む）"""
+    
+    __slots__ = ('latency', 'size')
+    
+    def __init__(self):
+        self.latency = 0.0
+        self.size = 0
+
+class HistoryRing:
+    """1サイト分の固定長リングバッファ（ファイルを mmap して読み書き）
+
+    開いたままにするとサイト数だけファイル記述子を消費するため、
+    with ブロックの間だけ開く。
+    """
+    
+    def __init__(self, path: str, capacity: int = HISTORY_CAPACITY):
+        if not os.path.exists(path):
+            self._create(path, capacity)
+        with open(path, 'r+b') as f:
+            self.map = mmap.mmap(f.fileno(), 0)
+        magic, self.capacity, _ = HISTORY_HEADER.unpack_from(self.map)
+        if magic in HISTORY_OLD_MAGICS:
+            self.map.close()
+            self._create(path, capacity)
+            with open(path, 'r+b') as f:
+                self.map = mmap.mmap(f.fileno(), 0)
+            magic, self.capacity, _ = HISTORY_HEADER.unpack_from(self.map)
+        if magic != HISTORY_MAGIC or len(self.map) < HISTORY_HEADER.size + self.capacity * HISTORY_RECORD.size:
+            self.map.close()
+            raise ValueError(f"履歴ファイルの形式が不正です: {path}")
+    
+    @staticmethod
+    def _create(path: str, capacity: int):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_file = path + '.tmp'
+        with open(temp_file, 'wb') as f:
+            f.write(HISTORY_HEADER.pack(HISTORY_MAGIC, capacity, 0))
+            f.truncate(HISTORY_HEADER.size + capacity * HISTORY_RECORD.size)
+        os.replace(temp_file, path)
+    
+    def __enter__(self) -> 'HistoryRing':
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    @property
+    def total(self) -> int:
+        return HISTORY_HEADER.unpack_from(self.map)[2]
+    
+    def _offset(self, index: int) -> int:
+        return HISTORY_HEADER.size + (index % self.capacity) * HISTORY_RECORD.size
+    
+    def append(self, timestamp: int, latency_ms: int, status: str, size: int):
+        """チェック結果を記録（直前の記録と同じ時間枠なら平均・最小・最大を取って1件にまとめる）"""
+        slot = timestamp - timestamp % HISTORY_RESOLUTION
+        failed = status == 'failed'
+        latency_ms = min(latency_ms, 0xFFFF)
+        total = self.total
+        if total:
+            last_slot, last_latency, latency_min, latency_max, checks, failures, changed, size_code = \
+                HISTORY_RECORD.unpack_from(self.map, self._offset(total - 1))
+            if last_slot == slot and checks < 255:
+                succeeded = checks - failures
+                if failed:
+                    average, size = last_latency, decode_history_size(size_code)
+                elif succeeded:
+                    average = (last_latency * succeeded + latency_ms) // (succeeded + 1)
+                    size = (decode_history_size(size_code) * succeeded + size) // (succeeded + 1)
+                    latency_min, latency_max = min(latency_min, latency_ms), max(latency_max, latency_ms)
+                else:
+                    average = latency_min = latency_max = latency_ms
+                HISTORY_RECORD.pack_into(
+                    self.map, self._offset(total - 1), slot, average, latency_min, latency_max,
+                    checks + 1, failures + failed, changed + (status == 'changed'), encode_history_size(size))
+                return
+        if failed:
+            latency_ms = size = 0
+        HISTORY_RECORD.pack_into(
+            self.map, self._offset(total), slot, latency_ms, latency_ms, latency_ms,
+            1, int(failed), int(status == 'changed'), encode_history_size(size))
+        # 件数は記録の後に更新（他プロセスの読み取りが書きかけの記録を見ないように）
+        HISTORY_HEADER.pack_into(self.map, 0, HISTORY_MAGIC, self.capacity, total + 1)
+    
+    def records(self) -> List[Tuple[int, int, int, int, int, int, int, int]]:
+        """保持中の記録を古い順に返す"""
+        total = self.total
+        count = min(total, self.capacity)
+        start = total % self.capacity if total > self.capacity else 0
+        body = memoryview(self.map)[HISTORY_HEADER.size:HISTORY_HEADER.size + self.capacity * HISTORY_RECORD.size]
+        try:
+            records = list(HISTORY_RECORD.iter_unpack(body))
+        finally:
+            body.release()
+        return (records[start:] + records[:start])[:count] if start else records[:count]
+    
+    def close(self):
+        self.map.close()
+
+class CheckHistory:
+    """サイト別チェック履歴（履歴ディレクトリに <サイトID>.bin を1ファイルずつ）
+
+    サイトごとのサイズは固定（HISTORY_CAPACITY 件）で、古い記録から上書きする。
+    """
+    
+    def __init__(self, root: Optional[str] = None):
+        self._root = root
+    
+    @property
+    def root(self) -> str:
+        if not self._root:
+            self._root = os.path.join(get_data_dir(), 'history')
+        return self._root
+    
+    def _path(self, site_id: int) -> str:
+        return os.path.join(self.root, f"{site_id}.bin")
+    
+    def record(self, site: 'SiteRecord', status: str, sample: CheckSample):
+        if site.id is None or status not in HISTORY_STATUSES:
+            return
+        try:
+            with HistoryRing(self._path(site.id)) as ring:
+                ring.append(int(time.time()), int(sample.latency * 1000), status, sample.size)
+        except (OSError, ValueError) as e:
+            logger.error(f"チェック履歴の記録エラー: {site.url} - {e}")
+    
+    def series(self, site_id: int, since: float, until: float, buckets: int) -> Dict:
+        """期間を buckets 個に分け、区間ごとの件数・失敗数・応答時間（最小/平均/最大）・平均サイズを返す
+
+        記録は HISTORY_RESOLUTION 秒の時間枠単位のため、since を含む枠も最初の区間に入れる。
+        """
+        span = max(until - since, 1.0)
+        slots = [None] * buckets
+        summary = {'checks': 0, 'failed': 0, 'changed': 0}
+        latency_total = 0
+        records = []
+        if os.path.exists(self._path(site_id)):
+            with HistoryRing(self._path(site_id)) as ring:
+                records = ring.records()
+        for timestamp, latency_ms, latency_min, latency_max, checks, failed, changed, size_code in records:
+            if not since - HISTORY_RESOLUTION < timestamp < until or not checks:
+                continue
+            index = max(int((timestamp - since) * buckets / span), 0)
+            slot = slots[index]
+            if slot is None:
+                slot = slots[index] = {
+                    'checks': 0, 'failed': 0, 'changed': 0, 'latency_min': None, 'latency_max': None,
+                    'latency_total': 0, 'succeeded': 0, 'size_total': 0}
+            succeeded = checks - failed
+            for key, value in (('checks', checks), ('failed', failed), ('changed', changed)):
+                slot[key] += value
+                summary[key] += value
+            if succeeded:
+                if slot['latency_min'] is None:
+                    slot['latency_min'], slot['latency_max'] = latency_min, latency_max
+                else:
+                    slot['latency_min'] = min(slot['latency_min'], latency_min)
+                    slot['latency_max'] = max(slot['latency_max'], latency_max)
+                slot['latency_total'] += latency_ms * succeeded
+                slot['succeeded'] += succeeded
+                slot['size_total'] += decode_history_size(size_code) * succeeded
+                latency_total += latency_ms * succeeded
+        
+        series = []
+        for index, slot in enumerate(slots):
+            point = {'t': datetime.fromtimestamp(since + span * index / buckets).isoformat(timespec='seconds')}
+            if slot:
+                succeeded = slot['succeeded']
+                point.update({
+                    'checks': slot['checks'],
+                    'failed': slot['failed'],
+                    'changed': slot['changed'],
+                    'uptime': round(1 - slot['failed'] / slot['checks'], 4),
+                    'latency_min': slot['latency_min'],
+                    'latency_avg': round(slot['latency_total'] / succeeded, 1) if succeeded else None,
+                    'latency_max': slot['latency_max'],
+                    'bytes_avg': round(slot['size_total'] / succeeded) if succeeded else None
+                })
+            else:
+                point['checks'] = 0
+            series.append(point)
+        
+        succeeded = summary['checks'] - summary['failed']
+        summary['uptime'] = round(succeeded / summary['checks'], 4) if summary['checks'] else None
+        summary['latency_avg'] = round(latency_total / succeeded, 1) if succeeded else None
+        return {'bucket_seconds': round(span / buckets, 1), 'resolution': HISTORY_RESOLUTION,
+                'summary': summary, 'series': series}
+    
+    def forget(self, site_id: int):
+        """サイト削除時に履歴を削除"""
+        path = self._path(site_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+# イベント配信設定
+EVENT_QUEUE_SIZE = 256
+EVENT_METRICS_INTERVAL = 15  # メトリクス差分の送信間隔（秒）
+STREAM_COUNTERS = ('total_checks', 'failed_checks', 'not_modified_checks',
+                   'email_sent', 'email_failed', 'cycle_overruns')
+
+class EventBroker:
+    """チェック結果を Server-Sent Events 購読者へ配信"""
+    
+    def __init__(self):
+        self.subscribers: Set[asyncio.Queue] = set()
+    
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        return queue
+    
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+    
+    def publish(self, event: str, data: Dict):
+        for queue in list(self.subscribers):
+            if queue.full():
+                queue.get_nowait()  # 受信の遅い購読者は古いイベントから捨てる
+            queue.put_nowait((event, data))
+
+event_broker = EventBroker()
+
+def publish_site_event(event: str, site: SiteRecord):
+    """サイト単位のイベント配信"""
+    if not event_broker.subscribers:
+        return
+    event_broker.publish(event, {
+        "id": site.id,
+        "url": site.url,
+        "name": site.name,
+        "last_check": site.last_check,
+        "last_notified": site.last_notified
+    })
+
+def format_sse(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
 
 # サービスインスタンス
 email_service = AsyncEmailService()
 site_checker = None  # 後で初期化
+scheduler = CheckScheduler()
+check_limiter = HostAwareLimiter()
+host_circuits = HostCircuitBreakers()
+adaptive_timeouts = AdaptiveTimeouts()
+retry_budget = RetryBudget()
+dns_resolver = CachingResolver()
+snapshot_store = SnapshotStore() if SNAPSHOTS_ENABLED else None
+check_history = CheckHistory() if HISTORY_ENABLED else None
+body_processor = BodyProcessor()
 
 # 簡単な認証関数
 def get_client_ip(request: Request) -> str:
@@ -269,9 +2433,7 @@ def get_client_ip(request: Request) -> str:
 def is_authenticated(request: Request) -> bool:
     """認証チェック"""
     try:
-        client_ip = get_client_ip(request)
-        is_logged_in = client_ip in logged_in_ips
-        return is_logged_in
+        return verify_session_token(request.cookies.get(SESSION_COOKIE)) is not None
     except Exception as e:
         logger.error(f"認証チェックエラー: {e}")
         return False
@@ -294,160 +2456,746 @@ def set_cached_data(key: str, data):
     cache[key] = data
     cache_ttl[key] = time.time()
 
-def load_sites() -> List[Dict]:
-    """サイトデータ読み込み（原子性保証）"""
+def get_data_dir() -> str:
+    """データディレクトリ取得（DATA_DIR 指定が無ければ Render.comのディスクパスを優先）"""
+    data_dir = os.getenv("DATA_DIR", '/opt/render/project/data')
     try:
-        # キャッシュチェック
-        cached = get_cached_data('sites_config')
-        if cached:
-            return cached
-        
-        # Render.comのディスクパスを優先
-        config_path = '/opt/render/project/data/config.json'
-        if not os.path.exists(config_path):
-            config_path = 'config.json'
+        os.makedirs(data_dir, exist_ok=True)
+        return data_dir
+    except OSError:
+        return '.'
+
+class SiteStorage:
+    """SQLite（WALモード）によるサイトデータ保存
+
+    サイトごとに1行を持ち、チェック結果は変更のあった行だけを更新する。
+    初回起動時に既存の config.json があれば取り込む。
+    """
+    
+    # 列名 → 型（不足している列は起動時に追加）
+    COLUMNS = {
+        'url': 'TEXT NOT NULL UNIQUE',
+        'email': 'TEXT NOT NULL',
+        'name': 'TEXT',
+        'created_at': 'TEXT',
+        'interval': 'INTEGER',
+        'detection': 'TEXT',
+        'change_threshold': 'INTEGER',
+        'ignore_pattern': 'TEXT',
+        'ignore_selectors': 'TEXT',
+        'feed_url': 'TEXT',
+        'hash': 'TEXT',
+        'hash_algo': 'TEXT',
+        'simhash': 'TEXT',
+        'feed_source': 'TEXT',
+        'etag': 'TEXT',
+        'last_modified': 'TEXT',
+        'last_check': 'TEXT',
+        'last_notified': 'TEXT',
+        'current_interval': 'REAL',
+        'next_check': 'TEXT'
+    }
+    
+    def __init__(self, path: Optional[str] = None):
+        self._path = path
+        self._conn: Optional[sqlite3.Connection] = None
+    
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = self._connect()
+        return self._conn
+    
+    def _connect(self) -> sqlite3.Connection:
+        path = self._path or os.path.join(get_data_dir(), 'sites.db')
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS sites (id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL UNIQUE, email TEXT NOT NULL)")
+        existing = {row['name'] for row in conn.execute("PRAGMA table_info(sites)")}
+        for column, column_type in self.COLUMNS.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE sites ADD COLUMN {column} {column_type.replace(' NOT NULL UNIQUE', '')}")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sites_next_check ON sites (next_check)")
+        conn.commit()
+        logger.info(f"🗄️ サイトDB: {path}")
+        self._migrate_from_json(conn, os.path.dirname(os.path.abspath(path)))
+        return conn
+    
+    def _migrate_from_json(self, conn: sqlite3.Connection, data_dir: str):
+        """既存の config.json を一度だけ取り込む"""
+        if conn.execute("SELECT COUNT(*) FROM sites").fetchone()[0]:
+            return
         
-        if os.path.exists(config_path):
+        # DB と同じデータディレクトリ → Render.comのディスクパス → 作業ディレクトリの順
+        candidates = (os.path.join(data_dir, 'config.json'), '/opt/render/project/data/config.json', 'config.json')
+        for config_path in dict.fromkeys(os.path.abspath(path) for path in candidates):
+            if not os.path.exists(config_path):
+                continue
             with open(config_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                sites = data.get('sites', [])
-                set_cached_data('sites_config', sites)
-                return sites
+                sites = json.load(f).get('sites', [])
+            with conn:
+                for site in sites:
+                    self._insert(conn, site)
+            os.replace(config_path, config_path + '.migrated')
+            logger.info(f"📦 config.json から{len(sites)}サイトを移行: {config_path}")
+            return
+    
+    def _insert(self, conn: sqlite3.Connection, site: Dict) -> int:
+        columns = [column for column in self.COLUMNS if site.get(column) is not None]
+        placeholders = ", ".join("?" for _ in columns)
+        cursor = conn.execute(
+            f"INSERT INTO sites ({', '.join(columns)}) VALUES ({placeholders})",
+            [site[column] for column in columns]
+        )
+        return cursor.lastrowid
+    
+    def load_all(self) -> List[Dict]:
+        rows = self.conn.execute("SELECT * FROM sites ORDER BY id").fetchall()
+        return [{key: row[key] for key in row.keys() if row[key] is not None} for row in rows]
+    
+    def insert_site(self, site: Dict) -> int:
+        with self.conn:
+            return self._insert(self.conn, site)
+    
+    def insert_sites(self, sites: List[Dict]) -> List[Optional[int]]:
+        """一括登録（1トランザクション）。登録済みURLの行は None を返す"""
+        ids = []
+        with self.conn:
+            for site in sites:
+                try:
+                    ids.append(self._insert(self.conn, site))
+                except sqlite3.IntegrityError:
+                    ids.append(None)
+        return ids
+    
+    def delete_site(self, site_id: int):
+        with self.conn:
+            self.conn.execute("DELETE FROM sites WHERE id = ?", (site_id,))
+    
+    def set_last_notified(self, url: str, timestamp: str):
+        """通知時刻だけを更新（担当ワーカーの状態保存とは独立）"""
+        with self.conn:
+            self.conn.execute("UPDATE sites SET last_notified = ? WHERE url = ?", (timestamp, url))
+    
+    def update_states(self, sites: List[SiteRecord]):
+        """チェック結果の列だけを行単位で更新（1トランザクション）"""
+        assignments = ", ".join(f"{key} = ?" for key in SITE_STATE_KEYS)
+        with self.conn:
+            self.conn.executemany(
+                f"UPDATE sites SET {assignments} WHERE id = ?",
+                [[getattr(site, key) for key in SITE_STATE_KEYS] + [site.id] for site in sites]
+            )
+
+class FeedEntryStore:
+    """feed 方式のサイトごとの既読エントリ（ハッシュを連結したBLOB）
+
+    サイト一覧の読み込みで毎回読まないよう sites とは別のテーブルに置く。
+    """
+    
+    def __init__(self, site_storage: SiteStorage):
+        self.storage = site_storage
+        self._ready = False
+    
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = self.storage.conn
+        if not self._ready:
+            conn.execute("CREATE TABLE IF NOT EXISTS feed_entries (site_id INTEGER PRIMARY KEY, entries BLOB NOT NULL)")
+            conn.commit()
+            self._ready = True
+        return conn
+    
+    def load(self, site_id: int) -> Optional[Set[bytes]]:
+        """既読エントリ（未取得のサイトは None）"""
+        row = self.conn.execute("SELECT entries FROM feed_entries WHERE site_id = ?", (site_id,)).fetchone()
+        return unpack_feed_entries(row['entries']) if row else None
+    
+    def save(self, site_id: int, entries: Set[bytes]):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO feed_entries (site_id, entries) VALUES (?, ?)",
+                              (site_id, pack_feed_entries(entries)))
+    
+    def delete(self, site_id: int):
+        with self.conn:
+            self.conn.execute("DELETE FROM feed_entries WHERE site_id = ?", (site_id,))
+
+class NotificationOutbox:
+    """永続化された通知アウトボックス
+
+    変更検知時は通知をDBに書き込むだけで即座に戻り、送信は別の
+    ワーカーが再試行・バックオフ付きで行う。再起動後も未送信分を送る。
+    ダイジェスト有効時は宛先ごとに期間内の通知を1通にまとめる。
+    """
+    
+    def __init__(self, site_storage: SiteStorage):
+        self.storage = site_storage
+        self.workers: List[asyncio.Task] = []
+        self._ready = False
+        self._wakeup = asyncio.Event()
+    
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = self.storage.conn
+        if not self._ready:
+            conn.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                site_url TEXT NOT NULL,
+                to_email TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                body TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                last_error TEXT
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt)")
+            conn.commit()
+            self._ready = True
+        return conn
+    
+    def enqueue(self, site_url: str, to_email: str, subject: str, body: str):
+        """通知を登録（ダイジェスト期間後に送信対象）
+
+        期間は宛先の最古の未送信通知から数える。同じ宛先の未送信分があれば
+        その送信時刻に揃え、期間内の通知が1通にまとまるようにする。
+        """
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT MIN(next_attempt) FROM outbox WHERE status = 'pending' AND to_email = ?",
+                (to_email,)
+            ).fetchone()
+            next_attempt = row[0] if row[0] is not None else time.time() + EMAIL_DIGEST_WINDOW
+            conn.execute(
+                "INSERT INTO outbox (site_url, to_email, subject, body, created_at, next_attempt) VALUES (?, ?, ?, ?, ?, ?)",
+                (site_url, to_email, subject, body, datetime.now().isoformat(), next_attempt)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        self._wakeup.set()
+    
+    def _claim(self) -> List[sqlite3.Row]:
+        """送信期限の来た最古の通知と、同じ宛先の期限到来分をまとめて確保
+
+        複数プロセスで同じ行を送らないよう書き込みロックを取って確保する。
+        送信中のまま期限切れになった行（プロセス停止など）も再確保の対象。
+        """
+        now = time.time()
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT to_email FROM outbox WHERE status IN ('pending', 'sending') AND next_attempt <= ? ORDER BY next_attempt LIMIT 1",
+                (now,)
+            ).fetchone()
+            if not row:
+                conn.commit()
+                return []
+            rows = conn.execute(
+                "SELECT * FROM outbox WHERE status IN ('pending', 'sending') AND to_email = ? AND next_attempt <= ? ORDER BY id LIMIT ?",
+                (row['to_email'], now, OUTBOX_BATCH_SIZE)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET status = 'sending', next_attempt = ? WHERE id = ?",
+                [(now + OUTBOX_CLAIM_TIMEOUT, r['id']) for r in rows]
+            )
+            conn.commit()
+            return rows
+        except Exception:
+            conn.rollback()
+            raise
+    
+    def _seconds_until_next(self) -> float:
+        row = self.conn.execute("SELECT MIN(next_attempt) FROM outbox WHERE status IN ('pending', 'sending')").fetchone()
+        if row[0] is None:
+            return SCHEDULER_MAX_SLEEP
+        return min(max(row[0] - time.time(), 0), SCHEDULER_MAX_SLEEP)
+    
+    async def _deliver(self, rows: List[sqlite3.Row]):
+        to_email = rows[0]['to_email']
+        if len(rows) == 1:
+            subject, body = rows[0]['subject'], rows[0]['body']
+        else:
+            subject = f"🔔 サイト更新通知: {len(rows)}件"
+            body = "\n".join(f"【{i}】{row['subject']}\n{row['body']}" for i, row in enumerate(rows, 1))
+        
+        error = "送信失敗"
+        try:
+            success = await email_service.send_email(to_email, subject, body)
+        except Exception as e:
+            success = False
+            error = str(e)
+        
+        if success:
+            with self.conn:
+                self.conn.executemany("DELETE FROM outbox WHERE id = ?", [(r['id'],) for r in rows])
+            for row in rows:
+                mark_notified(row['site_url'])
+            logger.info(f"✅ 通知完了: {len(rows)}件 → {to_email}")
+            return
+        
+        # 再試行（指数バックオフ、上限回数で dead）
+        updates = []
+        for row in rows:
+            attempts = row['attempts'] + 1
+            status = 'dead' if attempts >= OUTBOX_MAX_ATTEMPTS else 'pending'
+            next_attempt = time.time() + min(60 * (2 ** attempts), 3600)
+            updates.append((status, attempts, next_attempt, error, row['id']))
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?",
+                updates
+            )
+        logger.error(f"❌ 通知失敗: {len(rows)}件 → {to_email} (再試行予定)")
+    
+    async def _worker(self):
+        while True:
+            try:
+                rows = self._claim()
+                if rows:
+                    await self._deliver(rows)
+                    continue
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self._seconds_until_next())
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+            except Exception as e:
+                logger.error(f"通知ワーカーエラー: {e}")
+                await asyncio.sleep(5)
+    
+    def ensure_workers(self):
+        """通知ワーカーを起動（停止したものは再起動）"""
+        alive = [task for task in self.workers if not task.done()]
+        for _ in range(NOTIFIER_WORKERS - len(alive)):
+            alive.append(asyncio.create_task(self._worker()))
+        self.workers = alive
+    
+    async def stop(self):
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+    
+    def stats(self) -> Dict:
+        counts = dict(self.conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+        return {"pending": counts.get('pending', 0) + counts.get('sending', 0), "dead": counts.get('dead', 0)}
+
+storage = SiteStorage()
+notification_outbox = NotificationOutbox(storage)
+feed_entries = FeedEntryStore(storage)
+
+# 分散実行設定（同じ sites.db を共有するワーカー間でサイトを分担）
+LEASE_HEARTBEAT_INTERVAL = int(os.getenv("LEASE_HEARTBEAT_INTERVAL", "15"))
+LEASE_TTL = int(os.getenv("LEASE_TTL", "60"))
+
+class ShardLease:
+    """共有SQLiteのリースによるサイト分担
+
+    各ワーカーは定期的にハートビートを書き込み、有効なワーカー間で
+    ランデブーハッシュによりサイトを重複なく分担する。ワーカーが停止すると
+    リース切れ後に残りのワーカーへ自動で再配分される。
+    """
+    
+    def __init__(self, site_storage: SiteStorage):
+        self.storage = site_storage
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.workers: List[str] = [self.worker_id]
+        self._version = 0
+        self._last_heartbeat = 0.0
+        self._owner_cache: Dict[str, bool] = {}
+        self._ready = False
+    
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = self.storage.conn
+        if not self._ready:
+            conn.execute("CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, heartbeat REAL NOT NULL, started_at TEXT)")
+            conn.commit()
+            self._ready = True
+        return conn
+    
+    @property
+    def version(self) -> int:
+        """分担が変わるたびに変化する値（リース切れ時は -1）"""
+        if time.time() - self._last_heartbeat > LEASE_TTL:
+            return -1
+        return self._version
+    
+    def heartbeat(self) -> bool:
+        """リース更新と有効ワーカー一覧の再取得（分担が変わったら True）"""
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO workers (worker_id, heartbeat, started_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(worker_id) DO UPDATE SET heartbeat = excluded.heartbeat",
+                (self.worker_id, now, datetime.now().isoformat())
+            )
+            self.conn.execute("DELETE FROM workers WHERE heartbeat < ?", (now - LEASE_TTL,))
+        workers = sorted(row[0] for row in self.conn.execute("SELECT worker_id FROM workers"))
+        expired = now - self._last_heartbeat > LEASE_TTL
+        self._last_heartbeat = now
+        
+        if workers != self.workers or expired:
+            logger.info(f"🔀 ワーカー構成変更: {len(workers)}台 {workers}")
+            self.workers = workers
+            self._owner_cache = {}
+            self._version += 1
+            return True
+        return False
+    
+    def owns(self, url: str) -> bool:
+        """このワーカーが担当するサイトか（ランデブーハッシュ）"""
+        if self.version < 0:
+            return False  # 自分のリースが切れていれば他ワーカーに任せる
+        owned = self._owner_cache.get(url)
+        if owned is None:
+            owner = max(self.workers, key=lambda worker: hashlib.blake2b(
+                f"{worker}|{url}".encode('utf-8'), digest_size=8).digest())
+            owned = self._owner_cache[url] = owner == self.worker_id
+        return owned
+    
+    def release(self):
+        """終了時にリースを返却して即座に再配分させる"""
+        with self.conn:
+            self.conn.execute("DELETE FROM workers WHERE worker_id = ?", (self.worker_id,))
+    
+    def stats(self) -> Dict:
+        return {
+            "worker_id": self.worker_id,
+            "workers": len(self.workers),
+            "lease_valid": self.version >= 0
+        }
+
+shard_lease = ShardLease(storage)
+site_registry = SiteRegistry()
+
+# 他ワーカーによるサイト追加・削除を取り込む間隔（秒）
+SITES_REFRESH_INTERVAL = 30
+
+def mark_notified(url: str):
+    """送信完了したサイトの通知時刻を更新
+
+    outbox はどのワーカーでも送信するため、担当かどうかに関わらずDBへ書く。
+    担当ワーカーはサイト一覧の再読み込みで取り込む。
+    """
+    timestamp = datetime.now().isoformat()
+    storage.set_last_notified(url, timestamp)
+    site = site_registry.by_url(url)
+    if site is not None:
+        site.last_notified = timestamp
+        publish_site_event('notified', site)
+
+def load_sites():
+    """DBのサイト一覧をレジストリへ読み込み
+
+    チェック中・未保存・担当中のサイトはメモリ上のチェック結果を残し、
+    それ以外は他ワーカーが保存した結果で更新する。
+    """
+    try:
+        removed = site_registry.load(storage.load_all(), keep_state=scheduler.has_local_state)
+        for site in removed:
+            forget_site_data(site)  # 他ワーカーで削除されたサイト（削除後に書かれた分も消す）
     except Exception as e:
-        logger.error(f"設定ファイル読み込みエラー: {e}")
-    return []
+        logger.error(f"サイトデータ読み込みエラー: {e}")
+
+def forget_site_data(site: SiteRecord):
+    """削除したサイトの既読エントリ・チェック履歴・スナップショットを削除"""
+    feed_entries.delete(site.id)
+    feed_failures.pop(site.url, None)
+    if check_history:
+        check_history.forget(site.id)
+    if snapshot_store:
+        snapshot_store.forget(site.url)
 
-def save_sites(sites: List[Dict]):
-    """サイトデータ保存（原子性保証）"""
+def save_site_states(sites: List[SiteRecord]):
+    """チェック結果を変更のあったサイト分だけ保存"""
+    if not sites:
+        return
     try:
-        config = {
-            'sites': sites, 
-            'settings': {
-                'check_interval': int(os.getenv('CHECK_INTERVAL', '300')), 
-                'timeout': 10, 
-                'max_retries': 3
-            }
-        }
+        storage.update_states(sites)
+        logger.info(f"{len(sites)}サイトのチェック結果を保存")
+    except Exception as e:
+        logger.error(f"サイトデータ保存エラー: {e}")
+
+async def check_single_site(site: SiteRecord) -> str:
+    """単一サイトチェック（開始と結果をイベント配信）
+
+    戻り値はチェック結果（initial / changed / unchanged / failed）。
+    """
+    publish_site_event('check_started', site)
+    started = time.monotonic()
+    sample = CheckSample()
+    status = await _check_single_site(site, sample)
+    publish_site_event(status, site)
+    if CHECK_LOG_FORMAT == 'json':
+        log_check_record(site, status, time.monotonic() - started)
+    if check_history and site_registry.contains(site):
+        # 削除後に履歴ファイルを作り直さない。失敗時は取得時間が入らないため、枠待ちを含む所要時間を記録
+        if not sample.latency:
+            sample.latency = time.monotonic() - started
+        check_history.record(site, status, sample)
+    return status
+
+def log_check_record(site: SiteRecord, status: str, elapsed: float):
+    """チェック1回分を JSON Lines で記録（変更なしは CHECK_LOG_SAMPLE_UNCHANGED の割合だけ）"""
+    sample_rate = CHECK_LOG_SAMPLE_UNCHANGED if status == 'unchanged' else 1.0
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    check_logger.info(json.dumps({
+        'ts': datetime.now().isoformat(timespec='milliseconds'),
+        'site_id': site.id,
+        'url': site.url,
+        'status': status,
+        'ms': round(elapsed * 1000, 1),
+        'hash': (site.hash or '')[:12],
+        'sample_rate': sample_rate
+    }, ensure_ascii=False, separators=(',', ':')))
+
+async def _check_single_site(site: SiteRecord, sample: Optional[CheckSample] = None) -> str:
+    """単一サイトチェック本体"""
+    try:
+        url = site.url
+        email = site.email
+        name = site.name or url
+        if site_detection_mode(site) == 'feed':
+            return await _check_feed_site(site, sample)
+        # ハッシュ方式が異なる（旧形式を含む）場合は通知せず再取得し直す
+        last_hash = site.hash if site.hash_algo == HASH_ALGORITHM else ''
         
-        # Render.comのディスクパスを優先
-        config_path = '/opt/render/project/data/config.json'
-        config_dir = os.path.dirname(config_path)
+        # サイトチェック
+        snapshot = snapshot_store.writer() if snapshot_store else None
+        fingerprint = None
+        if site_detection_mode(site) == 'text':
+            fingerprint = TextFingerprinter(site.ignore_pattern, site.ignore_selectors)
+        # 同時実行枠は get_site_hash がページ取得の間だけ確保（通知送信中は他サイトに譲る）
+        result = await site_checker.get_site_hash(url, cached=site, snapshot=snapshot, fingerprint=fingerprint,
+                                                  sample=sample)
+        if not result:
+            return 'failed'
+        current_hash, validators = result
+        text_fingerprint = fingerprint.fingerprint if fingerprint else None
         
-        # ディレクトリが存在しない場合は作成
-        if not os.path.exists(config_dir):
-            try:
-                os.makedirs(config_dir, exist_ok=True)
-            except:
-                config_path = 'config.json'
+        # 初回チェック
+        if not last_hash:
+            site.hash = current_hash
+            site.hash_algo = HASH_ALGORITHM
+            site.simhash = text_fingerprint
+            site.update(validators)
+            site.last_check = datetime.now().isoformat()
+            record_snapshot(site, snapshot, current_hash)
+            logger.info(f"📝 初回ハッシュ設定: {name}")
+            return 'initial'
         
-        # 一時ファイルに書き込み → 原子的リネーム
-        temp_file = config_path + '.tmp'
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            json.dump(config, f, indent=2, ensure_ascii=False)
+        # 表示テキストが前回通知時から殆ど変わっていなければ通知しない
+        # （基準の SimHash は据え置き、小さな変更の積み重ねは閾値を超えた時点で通知）
+        if current_hash != last_hash and text_fingerprint and site.simhash:
+            distance = simhash_distance(site.simhash, text_fingerprint)
+            if distance <= site_change_threshold(site):
+                site.hash = current_hash
+                site.update(validators)
+                site.last_check = datetime.now().isoformat()
+                metrics['suppressed_changes'] += 1
+                logger.info(f"🔕 軽微な変更のため通知なし: {name} (距離 {distance})", extra={'per_check': True})
+                return 'unchanged'
         
-        os.replace(temp_file, config_path)
+        # 変更検知
+        if current_hash != last_hash:
+            logger.info(f"🚨 変更検知: {name}")
+            diff_text = record_snapshot(site, snapshot, current_hash)
+            
+            # 通知内容
+            subject = f"🔔 サイト更新通知: {name}"
+            body = f"""
+サイトが更新されました！
+
+サイト名: {name}
+URL: {url}
+更新検知時刻: {datetime.now().strftime('%Y年%m月%d日 %H:%M:%S')}
+"""
+            if diff_text:
+                body += f"""
+変更内容:
+{diff_text}
+"""
+            body += """
+このメールは Website Watcher により自動送信されました。
+"""
+            
+            # 送信は通知ワーカーに任せ、ハッシュは即座に更新
+            notification_outbox.enqueue(url, email, subject, body)
+            site.hash = current_hash
+            if text_fingerprint:
+                site.simhash = text_fingerprint
+            site.update(validators)
+            site.last_check = datetime.now().isoformat()
+            logger.info(f"📮 通知登録: {name} → {email}")
+            status = 'changed'
+        else:
+            if text_fingerprint and not site.simhash:
+                site.simhash = text_fingerprint  # text 方式に切り替えた直後の基準
+            site.update(validators)
+            site.last_check = datetime.now().isoformat()
+            logger.info(f"📍 変更なし: {name}", extra={'per_check': True})
+            status = 'unchanged'
         
-        # キャッシュ更新
-        set_cached_data('sites_config', sites)
-        logger.info("設定ファイル保存完了")
+        return status
         
     except Exception as e:
-        logger.error(f"設定ファイル保存エラー: {e}")
+        logger.error(f"サイトチェックエラー: {e}")
+        return 'failed'
 
-async def check_all_sites():
-    """全サイトチェック（並列処理）"""
-    global sites_data
-    
-    sites_data = load_sites()
-    if not sites_data:
-        logger.info("監視対象サイトがありません")
-        return
+async def _check_feed_site(site: SiteRecord, sample: Optional[CheckSample] = None) -> str:
+    """feed 方式のサイトチェック（フィード・サイトマップの新着エントリを通知）"""
+    url = site.url
+    name = site.name or url
     
-    logger.info(f"🔍 {len(sites_data)}サイトの監視を開始")
-    metrics['last_check_time'] = datetime.now()
+    feed_url = site.feed_url or site.feed_source
+    # 検出結果は取得・解析に成功するまで保存しない（推測の /sitemap.xml が無い場合など）。
+    # 保存済みの検出結果も失敗が続いたら検出し直す
+    if not site.feed_url and (not feed_url or feed_failures.get(url, 0) >= FEED_REDISCOVERY_FAILURES):
+        async with check_limiter.slot(url):
+            try:
+                feed_url = await site_checker.discover_feed(url)
+            except Exception as e:
+                logger.error(f"❌ フィード検出失敗: {url} - {e}")
+                metrics['failed_checks'] += 1
+                return 'failed'
+        logger.info(f"📡 フィード検出: {name} → {feed_url}")
     
-    # 最大5サイト並列処理
-    semaphore = asyncio.Semaphore(5)
-    tasks = []
+    # 前回と別のフィードを読む場合（feed_url 変更時など）は既読を引き継がない
+    known = feed_entries.load(site.id) if site.hash_algo == 'feed' and site.feed_source == feed_url else None
+    async with check_limiter.slot(feed_url):
+        result = await site_checker.get_feed_entries(feed_url, site, known or set(), sample)
+    if not result:
+        feed_failures[url] = feed_failures.get(url, 0) + 1
+        return 'failed'
+    feed_failures.pop(url, None)
+    parser, validators = result
+    site.update(validators)
+    site.last_check = datetime.now().isoformat()
+    if parser is None:
+        logger.info(f"📍 変更なし: {name}", extra={'per_check': True})
+        return 'unchanged'
     
-    for site in sites_data:
-        task = asyncio.create_task(check_single_site(site, semaphore))
-        tasks.append(task)
+    entries_hash = hashlib.blake2b(pack_feed_entries(parser.entries), digest_size=16).hexdigest()
+    if (entries_hash != site.hash or known is None) and site_registry.contains(site):
+        feed_entries.save(site.id, parser.entries)
+    site.hash = entries_hash
+    site.hash_algo = 'feed'
+    site.feed_source = feed_url
     
-    # 全サイトチェック完了を待機
-    await asyncio.gather(*tasks, return_exceptions=True)
+    if known is None:
+        logger.info(f"📝 初回エントリ記録: {name} ({len(parser.entries)}件)")
+        return 'initial'
+    if not parser.new_count:
+        logger.info(f"📍 変更なし: {name}", extra={'per_check': True})
+        return 'unchanged'
     
-    # 設定保存
-    save_sites(sites_data)
-
-async def check_single_site(site: Dict, semaphore: asyncio.Semaphore):
-    """単一サイトチェック"""
-    async with semaphore:
-        try:
-            url = site['url']
-            email = site['email']
-            name = site.get('name', url)
-            last_hash = site.get('hash', '')
-            
-            # サイトチェック
-            current_hash = await site_checker.get_site_hash(url)
-            if not current_hash:
-                return
-            
-            # 初回チェック
-            if not last_hash:
-                site['hash'] = current_hash
-                site['last_check'] = datetime.now().isoformat()
-                logger.info(f"📝 初回ハッシュ設定: {name}")
-                return
-            
-            # 変更検知
-            if current_hash != last_hash:
-                logger.info(f"🚨 変更検知: {name}")
-                
-                # メール送信
-                subject = f"🔔 サイト更新通知: {name}"
-                body = f"""
-サイトが更新されました！
+    logger.info(f"🚨 新着エントリ: {name} ({parser.new_count}件)")
+    entries_text = "\n".join(f"- {entry}" for entry in parser.new_entries)
+    if parser.new_count > len(parser.new_entries):
+        entries_text += f"\n  ほか{parser.new_count - len(parser.new_entries)}件"
+    subject = f"🔔 サイト更新通知: {name}（新着{parser.new_count}件）"
+    body = f"""
+サイトに新着エントリがあります！
 
 サイト名: {name}
 URL: {url}
+フィード: {feed_url}
 更新検知時刻: {datetime.now().strftime('%Y年%m月%d日 %H:%M:%S')}
 
+新着エントリ:
+{entries_text}
+
 このメールは Website Watcher により自動送信されました。
 """
-                
-                success = await email_service.send_email(email, subject, body)
-                if success:
-                    site['hash'] = current_hash
-                    site['last_check'] = datetime.now().isoformat()
-                    site['last_notified'] = datetime.now().isoformat()
-                    logger.info(f"✅ 通知完了: {name} → {email}")
-                else:
-                    logger.error(f"❌ 通知失敗: {name} → {email}")
-            else:
-                site['last_check'] = datetime.now().isoformat()
-                logger.info(f"📍 変更なし: {name}")
-            
-            # 負荷軽減用待機
-            await asyncio.sleep(1)
-            
-        except Exception as e:
-            logger.error(f"サイトチェックエラー: {e}")
+    notification_outbox.enqueue(url, site.email, subject, body)
+    logger.info(f"📮 通知登録: {name} → {site.email}")
+    return 'changed'
+
+def record_snapshot(site: SiteRecord, snapshot: Optional[SnapshotWriter], content_hash: str) -> str:
+    """スナップショットを保存し、前バージョンとの差分を返す（チェック中に削除されたサイトは保存しない）"""
+    if not snapshot or not snapshot.chunks or not site_registry.contains(site):
+        return ""
+    url = site.url
+    try:
+        versions = snapshot_store.record(url, snapshot, content_hash)
+        if snapshot_store.gc_due():
+            asyncio.get_running_loop().run_in_executor(None, snapshot_store.collect_garbage)
+        if len(versions) < 2:
+            return ""
+        return snapshot_store.diff(url, max_lines=SNAPSHOT_DIFF_MAX_LINES)
+    except Exception as e:
+        logger.error(f"スナップショット保存エラー: {url} - {e}")
+        return ""
+
+async def run_scheduled_check(site: SiteRecord) -> str:
+    """スケジュール済みチェックの実行と再スケジュール"""
+    status = 'failed'
+    try:
+        status = await check_single_site(site)
+    finally:
+        scheduler.complete(site, status)
+    return status
+
+site_check_tasks: Dict[str, asyncio.Task] = {}  # URL → 実行中のチェック
+feed_failures: Dict[str, int] = {}  # URL → feed 方式の連続取得失敗数
+
+def start_site_check(site: SiteRecord) -> asyncio.Task:
+    """サイトのチェックを開始（同じサイトのチェックが実行中ならそのタスクを返す）"""
+    url = site.url
+    task = site_check_tasks.get(url)
+    if task is None:
+        scheduler.claim(url)
+        task = asyncio.create_task(run_scheduled_check(site))
+        site_check_tasks[url] = task
+        task.add_done_callback(lambda done: site_check_tasks.pop(url, None) if site_check_tasks.get(url) is done else None)
+    return task
 
 async def monitoring_loop():
-    """監視ループ（指数バックオフ付き）"""
+    """監視ループ（サイト別スケジュール・指数バックオフ付き）
+
+    全サイトを一括でチェックせず、次回チェック時刻の早い順に
+    期限が来たサイトだけを個別タスクとして起動する。
+    """
     logger.info("🔄 監視ループ開始")
     consecutive_failures = 0
+    last_save = time.time()
+    last_refresh = time.time()
     
     while True:
         try:
-            await check_all_sites()
-            consecutive_failures = 0  # 成功時リセット
+            # チェック結果と次回チェック時刻をまとめて保存
+            if scheduler.dirty and time.time() - last_save >= SCHEDULE_SAVE_INTERVAL:
+                save_site_states(scheduler.take_dirty())
+                last_save = time.time()
             
-            check_interval = int(os.getenv("CHECK_INTERVAL", "300"))
-            logger.info(f"⏰ {check_interval}秒後に再チェック")
-            await asyncio.sleep(check_interval)
+            # 複数ワーカー時は他ワーカーの追加・削除・チェック結果を取り込む
+            if len(shard_lease.workers) > 1 and time.time() - last_refresh >= SITES_REFRESH_INTERVAL:
+                load_sites()
+                last_refresh = time.time()
+            
+            now = time.time()
+            scheduler.sync(site_registry, now, shard_lease)
+            
+            # 同時実行数の2倍までを投入（残りはヒープで待機）
+            capacity = MAX_CONCURRENT_CHECKS * 2 - len(scheduler.in_flight)
+            due_sites = scheduler.pop_due(now, capacity, blocked=lambda site: host_circuits.retry_at(site.url))
+            if due_sites:
+                metrics['last_check_time'] = datetime.now()
+                logger.info(f"🔍 {len(due_sites)}サイトのチェックを開始")
+            for site in due_sites:
+                start_site_check(site)
+            
+            consecutive_failures = 0  # 成功時リセット
+            await scheduler.wait(scheduler.seconds_until_next(time.time()))
             
         except Exception as e:
             consecutive_failures += 1
@@ -456,17 +3204,219 @@ async def monitoring_loop():
             logger.info(f"⏰ {wait_time}秒後にリトライ")
             await asyncio.sleep(wait_time)
 
+# 手動チェックジョブ設定
+CHECK_JOB_TTL = 3600  # 完了したジョブを保持する秒数
+MAX_CHECK_JOBS = 100
+
+class CheckJob:
+    """手動チェック1回分の進捗"""
+    
+    def __init__(self, job_id: str, key: Tuple, sites: List[SiteRecord], per_site: bool):
+        self.id = job_id
+        self.key = key  # 対象サイトIDの組（全サイトは ('all',)）
+        self.total = len(sites)
+        self.done = 0
+        self.coalesced = 0  # 実行中のチェックに相乗りした件数
+        self.counts: Counter = Counter()
+        self.results: Optional[Dict[int, str]] = {site.id: 'pending' for site in sites} if per_site else None
+        self.created_at = datetime.now()
+        self.finished_at: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+    
+    @property
+    def state(self) -> str:
+        return 'completed' if self.finished_at else 'running'
+    
+    def record(self, site: SiteRecord, status: str):
+        self.done += 1
+        self.counts[status] += 1
+        if self.results is not None:
+            self.results[site.id] = status
+    
+    def to_dict(self) -> Dict:
+        job = {
+            'job_id': self.id,
+            'state': self.state,
+            'total': self.total,
+            'done': self.done,
+            'coalesced': self.coalesced,
+            'counts': dict(self.counts),
+            'created_at': self.created_at.isoformat(),
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+        if self.results is not None:
+            job['results'] = self.results
+        return job
+
+class CheckJobs:
+    """手動チェックジョブの登録・実行（同じ対象の実行中ジョブには相乗りする）
+
+    ジョブはプロセス内に保持するため、複数ワーカー構成では
+    ジョブを受け付けたワーカーでのみ状態を確認できる。
+    """
+    
+    def __init__(self):
+        self._jobs: "OrderedDict[str, CheckJob]" = OrderedDict()
+    
+    def get(self, job_id: str) -> Optional[CheckJob]:
+        return self._jobs.get(job_id)
+    
+    def _prune(self):
+        """期限切れ・上限超過の完了ジョブを古い順に削除（実行中のジョブは残す）"""
+        cutoff = datetime.now() - timedelta(seconds=CHECK_JOB_TTL)
+        excess = len(self._jobs) - MAX_CHECK_JOBS + 1
+        for job in [job for job in self._jobs.values() if job.finished_at]:
+            if job.finished_at < cutoff or excess > 0:
+                del self._jobs[job.id]
+                excess -= 1
+    
+    def submit(self, sites: Optional[List[SiteRecord]] = None) -> Tuple[CheckJob, bool]:
+        """ジョブを登録して開始（戻り値の bool は既存ジョブへの相乗りか）
+
+        sites 未指定時は担当中の全サイト。
+        """
+        key = ('all',) if sites is None else tuple(sorted(site.id for site in sites))
+        for job in self._jobs.values():
+            if job.key == key and not job.finished_at:
+                return job, True
+        
+        self._prune()
+        targets = [site for site in site_registry.snapshot() if shard_lease.owns(site.url)] if sites is None else sites
+        job = CheckJob(secrets.token_hex(8), key, targets, per_site=sites is not None)
+        self._jobs[job.id] = job
+        job.task = asyncio.create_task(self._wait(job, self._start(job, targets)))
+        return job, False
+    
+    def _start(self, job: CheckJob, sites: List[SiteRecord]) -> Dict[asyncio.Task, SiteRecord]:
+        """各サイトのチェックを開始（実行中のサイトはそのチェックに相乗り）"""
+        now = time.time()
+        scheduler.sync(site_registry, now, shard_lease)
+        tasks = {}
+        for site in sites:
+            # 他ワーカー担当・停止中ホストのサイトは取得しない
+            if not shard_lease.owns(site.url):
+                job.record(site, 'not_owned')
+            elif host_circuits.retry_at(site.url) > now:
+                metrics['circuit_skipped_checks'] += 1
+                job.record(site, 'skipped')
+            else:
+                if site.url in site_check_tasks:
+                    job.coalesced += 1
+                tasks[start_site_check(site)] = site
+        if tasks:
+            logger.info(f"🔍 手動チェック開始: {len(tasks)}サイト (ジョブ {job.id})")
+            metrics['last_check_time'] = datetime.now()
+        return tasks
+    
+    async def _wait(self, job: CheckJob, tasks: Dict[asyncio.Task, SiteRecord]):
+        pending = set(tasks)
+        while pending:
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                status = 'failed' if task.cancelled() or task.exception() else task.result()
+                job.record(tasks[task], status)
+        
+        save_site_states(scheduler.take_dirty())
+        job.finished_at = datetime.now()
+        logger.info(f"✅ 手動チェック完了: ジョブ {job.id} {dict(job.counts)}")
+
+check_jobs = CheckJobs()
+
+# 接続事前準備設定
+PREWARM_ENABLED = os.getenv("PREWARM_ENABLED", "true").lower() == "true"  # 期限が近いホストのDNSを先読み
+CONNECTION_PREWARM = os.getenv("CONNECTION_PREWARM", "false").lower() == "true"  # HEAD で接続まで確立
+PREWARM_WINDOW = float(os.getenv("PREWARM_WINDOW", "3"))  # httpx のキープアライブ期限（5秒）より短くする
+PREWARM_INTERVAL = 1
+
+class ConnectionPrewarmer:
+    """期限が近いサイトの名前解決・接続確立をチェック前に済ませる
+
+    接続の事前確立はトップページへの HEAD で行うため、対象サイトへの
+    リクエストが増える。既定では DNS の先読みだけを行う。
+    """
+    
+    def __init__(self):
+        self._warmed: Dict[str, float] = {}  # ホスト → 最終実施時刻
+    
+    async def warm(self, site: SiteRecord):
+        parts = urlsplit(site.url)
+        try:
+            if DNS_CACHE_ENABLED:
+                await dns_resolver.resolve(parts.hostname or '')
+            if CONNECTION_PREWARM and httpx_client and check_limiter.try_acquire(site.url):
+                await httpx_client.head(f"{parts.scheme}://{parts.netloc}/",
+                                        timeout=adaptive_timeouts.timeout(site.url))
+        except Exception as e:
+            logger.debug(f"事前接続失敗: {parts.hostname} - {e}")
+    
+    def run(self, now: float):
+        for site in scheduler.upcoming(now, PREWARM_WINDOW, MAX_CONCURRENT_CHECKS * 2):
+            host = urlsplit(site.url).hostname or ''
+            if self._warmed.get(host, 0) > now - PREWARM_WINDOW * 2 or host_circuits.retry_at(site.url) > now:
+                continue
+            self._warmed[host] = now
+            asyncio.create_task(self.warm(site))
+        if len(self._warmed) > MAX_DNS_CACHE:
+            self._warmed = {host: at for host, at in self._warmed.items() if at > now - PREWARM_WINDOW * 2}
+
+prewarmer = ConnectionPrewarmer()
+
+async def prewarm_loop():
+    """期限が近いサイトの事前準備ループ"""
+    while True:
+        await asyncio.sleep(PREWARM_INTERVAL)
+        try:
+            prewarmer.run(time.time())
+        except Exception as e:
+            logger.error(f"事前接続ループエラー: {e}")
+
+def install_dns_cache(transport: httpx.AsyncHTTPTransport) -> bool:
+    """トランスポートの接続に DNS キャッシュを使わせる（できなければ False）
+
+    httpx には名前解決の差し替え口が無いため、内部の httpcore プールの
+    バックエンドを置き換える。非公開の属性なので、httpx / httpcore の
+    更新で構造が変わった場合は置き換えずに通常の名前解決で動かす。
+    """
+    pool = getattr(transport, '_pool', None)
+    backend = getattr(pool, '_network_backend', None)
+    if not isinstance(backend, httpcore.AsyncNetworkBackend):
+        logger.warning(f"⚠️ DNSキャッシュを使えません（httpcore {httpcore.__version__} の内部構造が想定と異なります）。"
+                       "通常の名前解決で続行します")
+        return False
+    pool._network_backend = CachingNetworkBackend(dns_resolver, backend)
+    return True
+
+def create_http_client(sites: Tuple[SiteRecord, ...]) -> httpx.AsyncClient:
+    """サイトチェック用の共有HTTPクライアント（DNSキャッシュ付き）
+
+    接続数の上限とDNSキャッシュのためトランスポートを明示するので、httpx は
+    環境変数のプロキシ設定（HTTP_PROXY / HTTPS_PROXY / ALL_PROXY / NO_PROXY）を
+    使わない。サイトチェックは常にプロキシを通さず直接接続する。
+    """
+    transport = httpx.AsyncHTTPTransport(limits=check_limiter.pool_limits(sites))
+    if DNS_CACHE_ENABLED:
+        install_dns_cache(transport)
+    if any(os.getenv(name) or os.getenv(name.lower()) for name in ('HTTP_PROXY', 'HTTPS_PROXY', 'ALL_PROXY')):
+        logger.warning("⚠️ プロキシの環境変数はサイトチェックには適用されません（直接接続します）")
+    return httpx.AsyncClient(timeout=httpx.Timeout(30.0), transport=transport)
+
 async def task_monitor():
-    """タスク監視（自動復旧）"""
+    """タスク監視（自動復旧・リース更新）"""
     global monitoring_task
     
     while True:
         try:
-            await asyncio.sleep(60)  # 1分ごとチェック
+            await asyncio.sleep(LEASE_HEARTBEAT_INTERVAL)
+            
+            # リース更新（担当サイトが変わったら監視ループを起こす）
+            if shard_lease.heartbeat():
+                scheduler.wake()
             
             if monitoring_task and monitoring_task.done():
                 logger.warning("⚠️ 監視タスクが停止。再起動します")
                 monitoring_task = asyncio.create_task(monitoring_loop())
+            
+            notification_outbox.ensure_workers()
                 
         except Exception as e:
             logger.error(f"タスク監視エラー: {e}")
@@ -507,11 +3457,10 @@ async def startup_event():
         else:
             logger.warning(f"⚠️ {name}: ファイルが見つかりません - {filepath}")
     
-    # HTTPクライアント初期化
-    httpx_client = httpx.AsyncClient(
-        timeout=httpx.Timeout(30.0),
-        limits=httpx.Limits(max_keepalive_connections=10, max_connections=20)
-    )
+    # サイト一覧読み込み・HTTPクライアント初期化
+    load_sites()
+    logger.info(f"📋 登録サイト: {len(site_registry)}件")
+    httpx_client = create_http_client(site_registry.snapshot())
     site_checker = AsyncSiteChecker(httpx_client)
     
     # 設定検証
@@ -520,20 +3469,25 @@ async def startup_event():
     if missing_env:
         logger.warning(f"⚠️ 未設定の環境変数: {missing_env}")
     
-    # SMTP接続テスト
-    if await email_service.test_connection():
-        logger.info("✅ メール設定確認完了")
-    else:
-        logger.warning("⚠️ メール設定に問題があります")
+    # SMTP接続テスト（結果は /api/health の smtp で確認）
+    asyncio.create_task(email_service.probe_until_ready())
     
     # 認証情報確認
     # 認証情報のログ出力
     logger.info("🔑 認証システム: 有効")
-    logger.info(f"📊 セッション数: {len(logged_in_ips)}")
+    if not os.getenv("SESSION_SECRET"):
+        session_secret()
+        logger.info(f"🔑 SESSION_SECRET 未設定のため {SESSION_SECRET_FILE} の署名鍵を使用")
+    logger.info(f"⏳ セッション有効期間: {SESSION_TTL}秒")
     
-    # 監視タスク開始
+    # リース取得・通知ワーカー・監視タスク開始
+    shard_lease.heartbeat()
+    notification_outbox.ensure_workers()
+    scheduler.start_warmup(time.time())
     monitoring_task = asyncio.create_task(monitoring_loop())
     asyncio.create_task(task_monitor())
+    if PREWARM_ENABLED:
+        asyncio.create_task(prewarm_loop())
 
 @app.on_event("shutdown")
 async def shutdown_event():
@@ -547,9 +3501,17 @@ async def shutdown_event():
         except asyncio.CancelledError:
             pass
     
+    # 次回チェック時刻を保存して再起動後にスケジュールを引き継ぐ
+    save_site_states(scheduler.take_dirty())
+    shard_lease.release()
+    
     if httpx_client:
         await httpx_client.aclose()
     
+    await notification_outbox.stop()
+    await email_service.close()
+    body_processor.shutdown()
+    
     logger.info("👋 Website Watcher 終了")
 
 
@@ -573,10 +3535,9 @@ async def login(request: Request, password: str = Form(...)):
         client_ip = get_client_ip(request)
         logger.info(f"🔑 ログイン試行 - IP: {client_ip}")
         
-        if password == AUTH_PASSWORD:
-            logged_in_ips.add(client_ip)
+        if hmac.compare_digest(password.encode(), AUTH_PASSWORD.encode()):
             logger.info(f"✅ ログイン成功 - IP: {client_ip}")
-            return RedirectResponse(url="/", status_code=303)
+            return set_session_cookie(RedirectResponse(url="/", status_code=303), request)
         else:
             logger.warning(f"❌ ログイン失敗 - IP: {client_ip}")
             return RedirectResponse(url="/login?error=1", status_code=303)
@@ -588,15 +3549,18 @@ async def login(request: Request, password: str = Form(...)):
 async def logout(request: Request):
     """ログアウト"""
     client_ip = get_client_ip(request)
-    was_logged_in = client_ip in logged_in_ips
-    logged_in_ips.discard(client_ip)
+    was_logged_in = is_authenticated(request)
     
     if os.getenv("ENVIRONMENT") == "production":
         logger.info(f"😪 ログアウト - IP: {client_ip}")
     else:
-        logger.info(f"😪 ログアウト - IP: {client_ip}, ログイン状態: {was_logged_in}, セッション数: {len(logged_in_ips)}")
+        logger.info(f"😪 ログアウト - IP: {client_ip}, ログイン状態: {was_logged_in}")
     
-    return RedirectResponse(url="/login", status_code=303)
+    # トークン自体は期限まで有効なため、全セッションを無効にするには SESSION_SECRET を変更する
+    # （未設定時は DATA_DIR の session_secret を削除して再起動）
+    response = RedirectResponse(url="/login", status_code=303)
+    response.delete_cookie(SESSION_COOKIE)
+    return response
 
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
@@ -633,12 +3597,12 @@ async def debug_auth(request: Request):
     """認証状態デバッグ情報"""
     try:
         client_ip = get_client_ip(request)
-        is_auth = is_authenticated(request)
+        expires = verify_session_token(request.cookies.get(SESSION_COOKIE))
         
         return {
             "client_ip": client_ip,
-            "is_authenticated": is_auth,
-            "session_count": len(logged_in_ips),
+            "is_authenticated": expires is not None,
+            "session_expires": datetime.fromtimestamp(expires).isoformat() if expires else None,
             "auth_status": "enabled"
         }
     except Exception as e:
@@ -656,8 +3620,10 @@ async def health_check(request: Request):
         "timestamp": datetime.now().isoformat(),
         "uptime_seconds": int(uptime.total_seconds()),
         "monitoring_active": monitoring_task and not monitoring_task.done(),
-        "sites_count": len(load_sites()),
-        "circuit_breakers_active": metrics['circuit_breaker_active']
+        "sites_count": len(site_registry),
+        "circuit_breakers_active": metrics['circuit_breaker_active'],
+        "circuits_open": host_circuits.stats()['open'],
+        "smtp": email_service.smtp_status
     }
 
 @app.get("/api/metrics")
@@ -667,62 +3633,436 @@ async def get_metrics(request: Request):
     return {
         "metrics": metrics,
         "uptime": str(datetime.now() - metrics['uptime_start']),
-        "cache_size": len(cache)
+        "cache_size": len(cache),
+        "scheduler": scheduler.stats(),
+        "outbox": notification_outbox.stats(),
+        "shard": shard_lease.stats(),
+        "circuits": host_circuits.stats(),
+        "retry_budget": retry_budget.stats(),
+        "dns": dns_resolver.stats(),
+        "latency_tracked_hosts": adaptive_timeouts.stats()['hosts']
     }
 
+def render_prometheus() -> str:
+    """Prometheus テキスト形式のメトリクス"""
+    lines = []
+    
+    def gauge(name: str, help_text: str, value, metric_type: str = "gauge"):
+        lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}", f"{name} {value}"])
+    
+    gauge("watcher_checks_total", "チェック成功数", metrics['total_checks'], "counter")
+    gauge("watcher_checks_failed_total", "チェック失敗数", metrics['failed_checks'], "counter")
+    gauge("watcher_checks_not_modified_total", "304応答数", metrics['not_modified_checks'], "counter")
+    gauge("watcher_emails_sent_total", "メール送信成功数", metrics['email_sent'], "counter")
+    gauge("watcher_emails_failed_total", "メール送信失敗数", metrics['email_failed'], "counter")
+    gauge("watcher_cycle_overruns_total", "1周期以上遅れたチェック数", metrics['cycle_overruns'], "counter")
+    gauge("watcher_offloaded_bodies_total", "別プロセスで処理した本文数", metrics['offloaded_bodies'], "counter")
+    gauge("watcher_suppressed_changes_total", "軽微な変更として通知しなかった数", metrics['suppressed_changes'], "counter")
+    
+    scheduler_stats = scheduler.stats()
+    gauge("watcher_scheduled_sites", "スケジュール済みサイト数", scheduler_stats['scheduled'])
+    gauge("watcher_in_flight_checks", "実行中チェック数", scheduler_stats['in_flight'])
+    gauge("watcher_overdue_sites", "予定時刻を過ぎたサイト数", scheduler_stats['overdue'])
+    gauge("watcher_outbox_pending", "未送信通知数", notification_outbox.stats()['pending'])
+    
+    # サーキットブレーカー状態
+    circuit_stats = host_circuits.stats()
+    lines.extend(["# HELP watcher_circuit_breakers ホスト別サーキットブレーカー状態別の数",
+                  "# TYPE watcher_circuit_breakers gauge"])
+    lines.extend(f'watcher_circuit_breakers{{state="{state}"}} {circuit_stats[state]}'
+                 for state in ("closed", "open", "half_open"))
+    dns_stats = dns_resolver.stats()
+    gauge("watcher_dns_cache_entries", "DNSキャッシュ件数", dns_stats['entries'])
+    gauge("watcher_dns_cache_hits_total", "DNSキャッシュヒット数", dns_stats['hits'], "counter")
+    gauge("watcher_dns_cache_misses_total", "DNSキャッシュミス数", dns_stats['misses'], "counter")
+    gauge("watcher_check_retries_total", "サイトチェックのリトライ数", metrics['check_retries'], "counter")
+    gauge("watcher_read_timeouts_total", "本文・応答待ちの読み取りタイムアウト数", metrics['read_timeouts'], "counter")
+    gauge("watcher_retries_denied_total", "リトライ予算切れで見送ったリトライ数", metrics['retries_denied'], "counter")
+    gauge("watcher_circuit_skipped_checks_total", "停止中ホストのため見送ったチェック数",
+          metrics['circuit_skipped_checks'], "counter")
+    gauge("watcher_email_circuit_open", "メール送信サーキットブレーカーがOPENなら1",
+          int(email_service.circuit_breaker.state == "OPEN"))
+    
+    for histogram in (prom_fetch_latency, prom_response_size, prom_cycle_duration,
+                      prom_schedule_lag, prom_slot_wait, prom_smtp_latency):
+        lines.extend(histogram.render())
+    lines.extend(prom_host_errors.render())
+    return "\n".join(lines) + "\n"
+
+@app.get("/metrics", response_class=PlainTextResponse)
+@limiter.limit("60/minute")
+async def prometheus_metrics(request: Request):
+    """Prometheus メトリクス（ホスト名を含むため認証必須）"""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if not (METRICS_TOKEN and scheme.lower() == 'bearer' and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())):
+        require_auth(request)
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/circuits")
+@limiter.limit("30/minute")
+async def get_circuits(request: Request):
+    """ホスト別サーキットブレーカー状態"""
+    require_auth(request)
+    return {"stats": host_circuits.stats(), "tripped": host_circuits.tripped()}
+
+@app.get("/api/events")
+@limiter.limit("10/minute")
+async def stream_events(request: Request):
+    """チェック結果のイベントストリーム（Server-Sent Events）
+
+    イベントはプロセス内の event_broker から配信するため、複数ワーカーでは
+    接続先のワーカーが担当するサイトの分だけが届く（他ワーカーの分は /api/sites で取得）。
+    """
+    require_auth(request)
+    queue = event_broker.subscribe()
+    
+    async def event_stream():
+        last = {key: metrics[key] for key in STREAM_COUNTERS}
+        next_metrics = time.monotonic() + EVENT_METRICS_INTERVAL
+        try:
+            yield format_sse('snapshot', {
+                "metrics": last,
+                "sites_count": len(site_registry),
+                "monitoring_active": bool(monitoring_task and not monitoring_task.done())
+            })
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), max(next_metrics - time.monotonic(), 0))
+                    yield format_sse(event, data)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+                
+                # 一定間隔でメトリクス差分（接続維持も兼ねる）
+                if await request.is_disconnected():
+                    break
+                current = {key: metrics[key] for key in STREAM_COUNTERS}
+                delta = {key: current[key] - last[key] for key in STREAM_COUNTERS if current[key] != last[key]}
+                last = current
+                next_metrics = time.monotonic() + EVENT_METRICS_INTERVAL
+                yield format_sse('metrics', {"delta": delta, "scheduler": scheduler.stats()})
+        finally:
+            event_broker.unsubscribe(queue)
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.get("/api/sites")
 @limiter.limit("120/minute")
 async def get_sites(request: Request):
-    """サイト一覧取得（キャッシュ付き）"""
+    """サイト一覧取得"""
     require_auth(request)
-    sites = load_sites()
-    return {"sites": sites}
+    return {"sites": [site.to_dict() for site in site_registry.snapshot()]}
 
 @app.post("/api/sites")
 @limiter.limit("10/minute")
 async def add_site(site: Site, request: Request):
     """サイト追加"""
     require_auth(request)
-    sites = load_sites()
     
     # 重複チェック
-    for existing_site in sites:
-        if existing_site['url'] == site.url:
-            raise HTTPException(status_code=400, detail="このURLは既に登録されています")
+    if site_registry.by_url(site.url):
+        raise HTTPException(status_code=400, detail="このURLは既に登録されています")
     
-    # URL検証
-    if not site.url.startswith(('http://', 'https://')):
-        raise HTTPException(status_code=400, detail="有効なURLを入力してください")
+    # URL検証・新サイト作成
+    try:
+        new_site = new_site_record(site)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    # 新サイト追加
-    new_site = {
-        "url": site.url,
-        "email": site.email,
-        "name": site.name or site.url,
-        "hash": "",
-        "created_at": datetime.now().isoformat()
-    }
+    try:
+        new_site.id = storage.insert_site(new_site.to_dict())
+    except sqlite3.IntegrityError:
+        raise HTTPException(status_code=400, detail="このURLは既に登録されています")
     
-    sites.append(new_site)
-    save_sites(sites)
+    site_registry.add(new_site)
+    scheduler.wake()
     
     logger.info(f"📝 新サイト登録: {site.name or site.url}")
-    return {"message": "サイトを登録しました", "site": new_site}
+    return {"message": "サイトを登録しました", "site": new_site.to_dict()}
+
+# 一括登録・エクスポート設定
+SITE_IMPORT_MAX_LINES = int(os.getenv("SITE_IMPORT_MAX_LINES", "50000"))
+SITE_IMPORT_MAX_LINE_LENGTH = 64 * 1024  # 1行（CSV は改行を含む1レコード）の上限文字数
+SITE_EXPORT_FIELDS = ('id',) + SITE_CONFIG_KEYS + ('last_check',)
+
+def new_site_record(site: Site) -> SiteRecord:
+    """登録内容を検証してサイトレコードを作成"""
+    if not site.url.startswith(('http://', 'https://')):
+        raise ValueError("有効なURLを入力してください")
+    if not site.email:
+        raise ValueError("通知先メールアドレスが必要です")
+    if site.detection and site.detection not in DETECTION_MODES:
+        raise ValueError(f"detection は {' / '.join(DETECTION_MODES)} のいずれかを指定してください")
+    if site.change_threshold is not None and not 0 <= site.change_threshold <= SIMHASH_BITS:
+        raise ValueError(f"change_threshold は 0〜{SIMHASH_BITS} で指定してください")
+    if site.ignore_pattern:
+        try:
+            re.compile(site.ignore_pattern)
+        except re.error as e:
+            raise ValueError(f"ignore_pattern が正規表現として不正です: {e}")
+    parse_ignore_selectors(site.ignore_selectors)
+    if site.feed_url and not site.feed_url.startswith(('http://', 'https://')):
+        raise ValueError("feed_url には http(s) のURLを指定してください")
+    return SiteRecord(
+        url=site.url,
+        email=site.email,
+        name=site.name or site.url,
+        created_at=datetime.now().isoformat(),
+        interval=max(site.interval, MIN_CHECK_INTERVAL) if site.interval else None,
+        detection=site.detection or None,
+        change_threshold=site.change_threshold,
+        ignore_pattern=site.ignore_pattern or None,
+        ignore_selectors=site.ignore_selectors or None,
+        feed_url=site.feed_url or None
+    )
+
+async def iter_upload_lines(request: Request):
+    """アップロード本文を受信しながら1行ずつ返す（本文全体は保持しない）
+
+    SITE_IMPORT_MAX_LINE_LENGTH を超える行は読み捨て、その行の代わりに ValueError を返す。
+    """
+    decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+    too_long = lambda: ValueError(f"1行が長すぎます（上限{SITE_IMPORT_MAX_LINE_LENGTH}文字）")
+    pending = ''
+    skipping = False  # 長すぎる行の残りを読み捨て中
+    async for chunk in request.stream():
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split('\n')
+        for line in lines:
+            if skipping:
+                skipping = False
+            elif len(line) > SITE_IMPORT_MAX_LINE_LENGTH:
+                yield too_long()
+            else:
+                yield line.rstrip('\r')
+        if len(pending) > SITE_IMPORT_MAX_LINE_LENGTH:
+            if not skipping:
+                yield too_long()
+                skipping = True
+            pending = ''
+    pending += decoder.decode(b'', final=True)
+    if pending and not skipping:
+        yield too_long() if len(pending) > SITE_IMPORT_MAX_LINE_LENGTH else pending.rstrip('\r')
+
+def csv_quote_open(line: str, quoted: bool = False) -> bool:
+    """CSV の1行を読んだ後、引用符で囲まれたフィールドが次の行へ続くか（csv モジュールの既定の解釈に合わせる）"""
+    state = 'quoted' if quoted else 'start'
+    for char in line:
+        if state == 'quoted':
+            if char == '"':
+                state = 'quote'
+        elif state == 'quote':
+            state = 'quoted' if char == '"' else ('start' if char == ',' else 'field')
+        elif char == ',':
+            state = 'start'
+        elif state == 'start':
+            state = 'quoted' if char == '"' else 'field'
+    return state == 'quoted'
+
+async def iter_upload_records(request: Request, upload_format: str):
+    """NDJSON / CSV の各行を (行番号, dict) で返す（解析できない行は例外を値として返す）
+
+    CSV は引用符内の改行を含むレコードを1件として読み、行番号は先頭行を返す。
+    """
+    header = None
+    line_no = 0
+    # CSV は1つの reader に行を渡し、レコードが閉じたところで1件ずつ読み出す
+    csv_lines = deque()
+    reader = csv.reader(iter(csv_lines.popleft, None))
+    record_start = 0
+    record_length = 0
+    quoted = False
+    async for line in iter_upload_lines(request):
+        line_no += 1
+        if isinstance(line, Exception):
+            if quoted:
+                csv_lines.clear()
+                quoted = False
+                yield record_start, ValueError("引用符が閉じられていません")
+            yield line_no, line
+            continue
+        try:
+            if upload_format == 'csv':
+                if not quoted:
+                    if not line.strip():
+                        continue
+                    record_start, record_length = line_no, 0
+                csv_lines.append(line + '\n')  # 引用符内の改行を値に残す
+                record_length += len(line) + 1
+                quoted = csv_quote_open(line, quoted)
+                if quoted:
+                    if record_length <= SITE_IMPORT_MAX_LINE_LENGTH:
+                        continue
+                    csv_lines.clear()
+                    quoted = False
+                    raise ValueError(f"1レコードが長すぎます（上限{SITE_IMPORT_MAX_LINE_LENGTH}文字）")
+                row = next(reader)
+                if header is None:
+                    header = [column.strip().lower() for column in row]
+                    if 'url' not in header or 'email' not in header:
+                        raise HTTPException(status_code=400, detail="CSVのヘッダー行に url, email 列が必要です")
+                    continue
+                record = {key: value.strip() for key, value in zip(header, row) if value.strip()}
+            else:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("JSONオブジェクトではありません")
+            yield (record_start if upload_format == 'csv' else line_no), record
+        except (ValueError, csv.Error) as e:
+            csv_lines.clear()  # 解析途中で止まったレコードの残り
+            yield (record_start if upload_format == 'csv' else line_no), e
+    if quoted:
+        yield record_start, ValueError("引用符が閉じられていません")
+
+def get_site_or_404(site_id: int) -> SiteRecord:
+    site = site_registry.get(site_id)
+    if site is None:
+        raise HTTPException(status_code=404, detail="サイトが見つかりません")
+    return site
+
+@app.post("/api/sites/import")
+@limiter.limit("5/minute")
+async def import_sites(request: Request, format: Optional[str] = None):
+    """サイト一括登録（NDJSON / CSV のストリーミングアップロード）
+
+    1回の受信で検証と重複排除を行い、1トランザクションで保存する。
+    戻り値は行ごとの結果（added / duplicate / invalid）。
+    """
+    require_auth(request)
+    upload_format = format or ('csv' if 'csv' in request.headers.get('content-type', '') else 'ndjson')
+    if upload_format not in ('ndjson', 'csv'):
+        raise HTTPException(status_code=400, detail="format は ndjson または csv を指定してください")
+    
+    report = []
+    new_sites: List[Tuple[Dict, SiteRecord]] = []
+    seen: Set[str] = set()
+    async for line_no, record in iter_upload_records(request, upload_format):
+        if len(report) >= SITE_IMPORT_MAX_LINES:
+            raise HTTPException(status_code=413, detail=f"一度に登録できるのは{SITE_IMPORT_MAX_LINES}行までです")
+        entry = {"line": line_no}
+        report.append(entry)
+        try:
+            if isinstance(record, Exception):
+                raise record
+            new_site = new_site_record(Site(**record))
+        except ValidationError as e:
+            entry.update(status="invalid", error="; ".join(
+                f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()))
+            continue
+        except (ValueError, TypeError) as e:
+            entry.update(status="invalid", error=str(e))
+            continue
+        
+        if new_site.url in seen or site_registry.by_url(new_site.url):
+            entry.update(status="duplicate", url=new_site.url)
+            continue
+        seen.add(new_site.url)
+        new_sites.append((entry, new_site))
+    
+    # 1トランザクションで保存（他ワーカーが先に登録したURLは重複扱い）
+    ids = storage.insert_sites([new_site.to_dict() for _, new_site in new_sites]) if new_sites else []
+    for (entry, new_site), site_id in zip(new_sites, ids):
+        if site_id is None:
+            entry.update(status="duplicate", url=new_site.url)
+            continue
+        new_site.id = site_id
+        site_registry.add(new_site)
+        entry.update(status="added", id=site_id, url=new_site.url)
+    if new_sites:
+        scheduler.wake()
+    
+    summary = {status: sum(1 for entry in report if entry["status"] == status)
+               for status in ("added", "duplicate", "invalid")}
+    logger.info(f"📥 サイト一括登録: {summary}")
+    return {"message": f"{summary['added']}サイトを登録しました", "summary": summary, "report": report}
+
+@app.get("/api/sites/export")
+@limiter.limit("10/minute")
+async def export_sites(request: Request, format: str = 'ndjson'):
+    """サイト一覧のストリーミングエクスポート（NDJSON / CSV）"""
+    require_auth(request)
+    if format not in ('ndjson', 'csv'):
+        raise HTTPException(status_code=400, detail="format は ndjson または csv を指定してください")
+    sites = site_registry.snapshot()
+    
+    def csv_line(values) -> str:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(values)
+        return buffer.getvalue()
+    
+    def export_stream():
+        if format == 'csv':
+            yield csv_line(SITE_EXPORT_FIELDS)
+        for site in sites:
+            values = [getattr(site, key) for key in SITE_EXPORT_FIELDS]
+            if format == 'csv':
+                yield csv_line(['' if value is None else value for value in values])
+            else:
+                row = {key: value for key, value in zip(SITE_EXPORT_FIELDS, values) if value is not None}
+                yield json.dumps(row, ensure_ascii=False) + "\n"
+    
+    media_type = "text/csv; charset=utf-8" if format == 'csv' else "application/x-ndjson"
+    filename = f"sites.{'csv' if format == 'csv' else 'ndjson'}"
+    return StreamingResponse(export_stream(), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
-@app.delete("/api/sites/{site_index}")
+@app.delete("/api/sites/{site_id}")
 @limiter.limit("10/minute")
-async def delete_site(site_index: int, request: Request):
+async def delete_site(site_id: int, request: Request):
     """サイト削除"""
     require_auth(request)
-    sites = load_sites()
+    deleted_site = get_site_or_404(site_id)
     
-    if 0 <= site_index < len(sites):
-        deleted_site = sites.pop(site_index)
-        save_sites(sites)
-        logger.info(f"🗑️ サイト削除: {deleted_site.get('name', deleted_site['url'])}")
-        return {"message": "サイトを削除しました"}
-    else:
-        raise HTTPException(status_code=404, detail="サイトが見つかりません")
+    storage.delete_site(site_id)
+    site_registry.remove(site_id)
+    # 実行中のチェックは登録解除を見て結果を書かない
+    forget_site_data(deleted_site)
+    logger.info(f"🗑️ サイト削除: {deleted_site.name or deleted_site.url}")
+    return {"message": "サイトを削除しました"}
+
+@app.get("/api/sites/{site_id}/history")
+@limiter.limit("60/minute")
+async def get_site_history(site_id: int, request: Request):
+    """スナップショット履歴取得"""
+    require_auth(request)
+    site = get_site_or_404(site_id)
+    if not snapshot_store:
+        raise HTTPException(status_code=404, detail="スナップショットは無効です")
+    
+    versions = snapshot_store.load_versions(site.url)
+    return {"versions": [
+        {"index": i, "timestamp": v['timestamp'], "hash": v['hash'], "size": v['size']}
+        for i, v in enumerate(versions)
+    ]}
+
+@app.get("/api/sites/{site_id}/timeseries")
+@limiter.limit("60/minute")
+async def get_site_timeseries(site_id: int, request: Request, hours: float = 24, buckets: int = 48):
+    """チェック履歴の時系列（区間ごとの応答時間 min/avg/max・稼働率など）"""
+    require_auth(request)
+    site = get_site_or_404(site_id)
+    if not check_history:
+        raise HTTPException(status_code=404, detail="チェック履歴は無効です")
+    if hours <= 0 or not 1 <= buckets <= HISTORY_MAX_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"hours は正の値、buckets は 1〜{HISTORY_MAX_BUCKETS} で指定してください")
+    until = time.time()
+    series = check_history.series(site.id, until - hours * 3600, until, buckets)
+    return {"site_id": site.id, "url": site.url, "hours": hours, **series}
+
+@app.get("/api/sites/{site_id}/diff")
+@limiter.limit("30/minute")
+async def get_site_diff(site_id: int, request: Request, from_version: int = -2, to_version: int = -1):
+    """スナップショット間の差分取得"""
+    require_auth(request)
+    site = get_site_or_404(site_id)
+    if not snapshot_store:
+        raise HTTPException(status_code=404, detail="スナップショットは無効です")
+    
+    diff_text = snapshot_store.diff(site.url, from_version, to_version)
+    return {"diff": diff_text}
 
 @app.post("/api/test-email")
 @limiter.limit("5/minute")
@@ -747,14 +4087,44 @@ async def test_email(email_data: dict, request: Request):
     else:
         raise HTTPException(status_code=500, detail="メール送信に失敗しました")
 
+class CheckRequest(BaseModel):
+    site_ids: Optional[List[int]] = None  # 未指定時は全サイト
+
+def check_job_response(job: CheckJob, coalesced: bool) -> JSONResponse:
+    body = job.to_dict()
+    body['status_url'] = f"/api/check-jobs/{job.id}"
+    body['message'] = "実行中のチェックに相乗りしました" if coalesced else "チェックを開始しました"
+    return JSONResponse(body, status_code=202)
+
 @app.post("/api/check-now")
 @limiter.limit("3/minute")
-async def check_now(request: Request):
-    """手動チェック実行"""
+async def check_now(request: Request, check: Optional[CheckRequest] = None):
+    """手動チェック実行（完了を待たずジョブIDを返す）"""
+    require_auth(request)
+    sites = None
+    if check and check.site_ids is not None:
+        sites = [get_site_or_404(site_id) for site_id in dict.fromkeys(check.site_ids)]
+        if not sites:
+            raise HTTPException(status_code=400, detail="site_ids が空です")
+    logger.info(f"🔍 手動チェック実行: {'全サイト' if sites is None else f'{len(sites)}サイト'}")
+    return check_job_response(*check_jobs.submit(sites))
+
+@app.post("/api/sites/{site_id}/check")
+@limiter.limit("20/minute")
+async def check_site_now(request: Request, site_id: int):
+    """1サイトの手動チェック（完了を待たずジョブIDを返す）"""
+    require_auth(request)
+    return check_job_response(*check_jobs.submit([get_site_or_404(site_id)]))
+
+@app.get("/api/check-jobs/{job_id}")
+@limiter.limit("120/minute")
+async def get_check_job(request: Request, job_id: str):
+    """手動チェックジョブの進捗"""
     require_auth(request)
-    logger.info("🔍 手動チェック実行")
-    await check_all_sites()
-    return {"message": "チェックを実行しました"}
+    job = check_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+    return job.to_dict()
 
 # 緊急ログイン用（テスト環境のみ）
 @app.post("/emergency-login")
@@ -766,15 +4136,15 @@ async def emergency_login(request: Request):
         raise HTTPException(status_code=404, detail="Not found")
     
     client_ip = get_client_ip(request)
-    logged_in_ips.add(client_ip)
     logger.info(f"🆘 緊急ログイン - IP: {client_ip}")
     
-    return {
+    response = JSONResponse({
         "message": "緊急ログイン成功",
-        "client_ip": client_ip,
-        "session_count": len(logged_in_ips)
-    }
+        "client_ip": client_ip
+    })
+    return set_session_cookie(response, request)
 
 if __name__ == "__main__":
+    import uvicorn
     port = int(os.getenv("PORT", "8888"))
     uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")
\ No newline at end of file
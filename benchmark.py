@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""Website Watcher 負荷ベンチマーク
+
+ローカルに疑似サイト群（HTTP）とSMTPシンクを別プロセスで起動し、
+本物の手動チェックジョブ（check_jobs）/ monitoring_loop / AsyncEmailService を実行して
+スループット・チェック遅延・ピークRSS・メール送信速度を計測する。
+
+例:
+    python benchmark.py --sites 5000 --concurrency 50 --cycles 3
+    python benchmark.py --mode loop --duration 60 --interval 10
+    python benchmark.py --sites 2000 --json > result.json
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from typing import Tuple
+
+app_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+# ---------------------------------------------------------------------------
+# 疑似サイト群
+# ---------------------------------------------------------------------------
+
+class SiteFarm:
+    """/site/<番号> で多数のサイトを模擬するHTTPサーバー
+
+    リクエストごとに change_rate の確率で内容が変わり、error_rate の確率で
+    503 を返す。etag が有効なら If-None-Match に 304 で応答する。
+    """
+
+    def __init__(self, latency: float, body_size: int, change_rate: float,
+                 error_rate: float, etag: bool):
+        self.latency = latency
+        self.change_rate = change_rate
+        self.error_rate = error_rate
+        self.etag = etag
+        self.versions = {}
+        line = b"<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>\n"
+        self.base_body = (line * (body_size // len(line) + 1))[:max(body_size - 48, 0)]
+
+    def _response(self, site_id: int, if_none_match: str):
+        if random.random() < self.error_rate:
+            return 503, {}, b"unavailable"
+
+        version = self.versions.get(site_id, 0)
+        if random.random() < self.change_rate:
+            version = self.versions[site_id] = version + 1
+        etag = f'"{site_id}-{version}"'
+        if self.etag and if_none_match == etag:
+            return 304, {"ETag": etag}, b""
+
+        body = self.base_body + f"<!-- site {site_id} version {version} -->\n".encode()
+        return 200, {"ETag": etag} if self.etag else {}, body
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+
+                if self.latency:
+                    await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+                try:
+                    site_id = int(request_line.split()[1].rsplit(b"/", 1)[-1])
+                    status, extra, body = self._response(site_id, headers.get("if-none-match", ""))
+                except (IndexError, ValueError):
+                    status, extra, body = 404, {}, b"not found"
+
+                reason = {200: "OK", 304: "Not Modified", 404: "Not Found", 503: "Service Unavailable"}[status]
+                head = [f"HTTP/1.1 {status} {reason}", "Content-Type: text/html; charset=utf-8",
+                        f"Content-Length: {len(body)}"]
+                head.extend(f"{key}: {value}" for key, value in extra.items())
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+# ---------------------------------------------------------------------------
+# SMTPシンク
+# ---------------------------------------------------------------------------
+
+class SMTPSink:
+    """受信したメールを数えるだけのSMTPサーバー（AUTH PLAIN / LOGIN を受理）"""
+
+    def __init__(self, counter):
+        self.counter = counter
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        def reply(line: str):
+            writer.write(line.encode() + b"\r\n")
+
+        try:
+            reply("220 sink ESMTP")
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode("latin-1").strip()
+                verb = command.split(" ", 1)[0].upper()
+
+                if verb in ("EHLO", "HELO"):
+                    writer.write(b"250-sink\r\n250-AUTH PLAIN LOGIN\r\n250-8BITMIME\r\n250 SIZE 52428800\r\n")
+                elif verb == "AUTH":
+                    if command.upper().startswith("AUTH LOGIN"):
+                        reply("334 " + base64.b64encode(b"Username:").decode())
+                        await writer.drain()
+                        await reader.readline()
+                        reply("334 " + base64.b64encode(b"Password:").decode())
+                        await writer.drain()
+                        await reader.readline()
+                    elif len(command.split()) == 2:
+                        reply("334 ")
+                        await writer.drain()
+                        await reader.readline()
+                    reply("235 2.7.0 Authentication successful")
+                elif verb == "DATA":
+                    reply("354 End data with <CR><LF>.<CR><LF>")
+                    await writer.drain()
+                    while (await reader.readline()) not in (b".\r\n", b".\n", b""):
+                        pass
+                    with self.counter.get_lock():
+                        self.counter.value += 1
+                    reply("250 2.0.0 Ok: queued")
+                elif verb == "QUIT":
+                    reply("221 2.0.0 Bye")
+                    await writer.drain()
+                    break
+                else:
+                    reply("250 2.0.0 Ok")  # MAIL / RCPT / NOOP / RSET
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def _serve(handler, conn):
+    """別プロセスでサーバーを起動し、待受ポートをパイプで返す"""
+    async def main():
+        server = await asyncio.start_server(handler.handle, "127.0.0.1", 0, backlog=4096)
+        conn.send(server.sockets[0].getsockname()[1])
+        async with server:
+            await server.serve_forever()
+    asyncio.run(main())
+
+
+def start_server_process(handler) -> Tuple[multiprocessing.Process, int]:
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve, args=(handler, child), daemon=True)
+    process.start()
+    return process, parent.recv()
+
+
+# ---------------------------------------------------------------------------
+# 計測
+# ---------------------------------------------------------------------------
+
+def percentile(samples, p: float) -> float:
+    if not samples:
+        return 0.0
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method="inclusive")[int(p) - 1]
+
+
+def peak_rss_mb() -> float:
+    # Linux は KB、macOS はバイト単位
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+async def wait_outbox_drained(app, timeout: float):
+    """アウトボックスが空になるまで待機"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if app.notification_outbox.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 0:
+            return True
+        await asyncio.sleep(0.2)
+    return False
+
+
+async def renew_lease(app):
+    """シャードのリースを定期更新（担当サイトが変わったら監視ループを起こす）"""
+    interval = min(app.LEASE_HEARTBEAT_INTERVAL, app.LEASE_TTL / 3)
+    while True:
+        await asyncio.sleep(interval)
+        if app.shard_lease.heartbeat():
+            app.scheduler.wake()
+
+
+async def run_benchmark(app, args, farm_port: int, sent_counter) -> dict:
+    # サイト登録
+    app.storage.insert_sites([{
+        "url": f"http://127.0.0.1:{farm_port}/site/{i}",
+        "email": f"user{i % args.recipients}@bench.local",
+        "name": f"bench-{i}",
+        "interval": args.interval if args.mode == "loop" else None
+    } for i in range(args.sites)])
+    app.load_sites()
+    app.shard_lease.heartbeat()
+
+    # startup_event と同じ構成のクライアント
+    app.httpx_client = app.create_http_client(app.site_registry.snapshot())
+    app.site_checker = app.AsyncSiteChecker(app.httpx_client)
+    app.notification_outbox.ensure_workers()
+
+    # check_single_site（枠待ち・通知登録を含む）と取得処理を包んで所要時間を記録
+    latencies = []
+    fetch_latencies = []
+    check_single_site = app.check_single_site
+    # 枠の確保は get_site_hash 内の試行ごとに行うため、枠を確保した後の取得本体を計る
+    fetch = app.site_checker._check_site_core
+
+    async def timed_check(site):
+        started = time.perf_counter()
+        try:
+            return await check_single_site(site)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    async def timed_fetch(*fetch_args, **fetch_kwargs):
+        started = time.perf_counter()
+        try:
+            return await fetch(*fetch_args, **fetch_kwargs)
+        finally:
+            fetch_latencies.append(time.perf_counter() - started)
+
+    app.check_single_site = timed_check
+    app.site_checker._check_site_core = timed_fetch
+    result = {"mode": args.mode, "sites": args.sites, "concurrency": app.MAX_CONCURRENT_CHECKS}
+
+    # 本番の task_monitor と同様にリースを更新し続ける（LEASE_TTL を過ぎると担当サイトを失うため）
+    lease_task = asyncio.create_task(renew_lease(app))
+    try:
+        started = time.perf_counter()
+        if args.mode == "cycle":
+            cycles = []
+            for _ in range(args.cycles):
+                cycle_started = time.perf_counter()
+                job, _ = app.check_jobs.submit()
+                await job.task
+                cycles.append(time.perf_counter() - cycle_started)
+            result["cycle_seconds"] = [round(seconds, 3) for seconds in cycles]
+        else:
+            monitoring_task = asyncio.create_task(app.monitoring_loop())
+            await asyncio.sleep(args.duration)
+            monitoring_task.cancel()
+            try:
+                await monitoring_task
+            except asyncio.CancelledError:
+                pass
+        elapsed = time.perf_counter() - started
+    finally:
+        lease_task.cancel()
+
+    # 変更通知の送信完了待ち
+    notify_started = time.perf_counter()
+    drained = await wait_outbox_drained(app, args.drain_timeout)
+    notify_elapsed = time.perf_counter() - notify_started
+    notified = sent_counter.value
+
+    # AsyncEmailService 単体の送信速度
+    direct_rate = None
+    if args.emails:
+        email_started = time.perf_counter()
+        results = await asyncio.gather(*[
+            app.email_service.send_email(f"direct{i}@bench.local", "benchmark", "benchmark body")
+            for i in range(args.emails)
+        ])
+        direct_elapsed = time.perf_counter() - email_started
+        direct_rate = round(sum(results) / direct_elapsed, 1)
+        result["direct_emails_failed"] = args.emails - sum(results)
+
+    await app.notification_outbox.stop()
+    await app.email_service.close()
+    await app.httpx_client.aclose()
+
+    result.update({
+        "checks": len(latencies),
+        "elapsed_seconds": round(elapsed, 3),
+        "sites_per_second": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "check_latency_p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "check_latency_p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "fetch_latency_p50_ms": round(percentile(fetch_latencies, 50) * 1000, 1),
+        "fetch_latency_p99_ms": round(percentile(fetch_latencies, 99) * 1000, 1),
+        "failed_checks": app.metrics["failed_checks"],
+        "not_modified_checks": app.metrics["not_modified_checks"],
+        "notification_emails": notified,
+        "notification_drained": drained,
+        "notification_drain_seconds": round(notify_elapsed, 3),
+        "direct_emails_per_second": direct_rate,
+        "peak_rss_mb": round(peak_rss_mb(), 1)
+    })
+    return result
+
+
+def print_report(result: dict):
+    labels = [
+        ("mode", "モード"), ("sites", "サイト数"), ("concurrency", "同時実行数"),
+        ("cycle_seconds", "周回時間(秒)"), ("checks", "チェック数"), ("elapsed_seconds", "所要時間(秒)"),
+        ("sites_per_second", "サイト/秒"), ("check_latency_p50_ms", "チェック遅延 p50(ms)"),
+        ("check_latency_p99_ms", "チェック遅延 p99(ms)"), ("fetch_latency_p50_ms", "取得遅延 p50(ms)"),
+        ("fetch_latency_p99_ms", "取得遅延 p99(ms)"), ("failed_checks", "失敗数"),
+        ("not_modified_checks", "304応答数"), ("notification_emails", "通知メール数"),
+        ("notification_drained", "通知送信完了"), ("notification_drain_seconds", "チェック後の送信待ち(秒)"),
+        ("direct_emails_per_second", "直接送信メール/秒"), ("direct_emails_failed", "直接送信失敗数"),
+        ("peak_rss_mb", "ピークRSS(MB)")
+    ]
+    print("\n📊 ベンチマーク結果")
+    for key, label in labels:
+        if key in result and result[key] is not None:
+            print(f"  {label:<24} {result[key]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Website Watcher 負荷ベンチマーク")
+    parser.add_argument("--mode", choices=("cycle", "loop"), default="cycle",
+                        help="cycle: 全サイトの手動チェックジョブを周回 / loop: monitoring_loop を一定時間実行")
+    parser.add_argument("--sites", type=int, default=2000)
+    parser.add_argument("--cycles", type=int, default=2, help="cycle モードの周回数（1周目は初回ハッシュ）")
+    parser.add_argument("--duration", type=float, default=30, help="loop モードの実行秒数")
+    parser.add_argument("--interval", type=int, default=10, help="loop モードのサイト別チェック間隔（秒）")
+    parser.add_argument("--latency", type=float, default=0.05, help="疑似サイトの平均応答遅延（秒）")
+    parser.add_argument("--body-size", type=int, default=20000, help="疑似サイトの本文サイズ（バイト）")
+    parser.add_argument("--change-rate", type=float, default=0.1, help="リクエストごとに内容が変わる確率")
+    parser.add_argument("--error-rate", type=float, default=0.01, help="503 を返す確率")
+    parser.add_argument("--no-etag", action="store_true", help="ETag / 304 を無効化")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("MAX_CONCURRENT_CHECKS", "10")))
+    parser.add_argument("--host-rate", type=float, default=1000,
+                        help="ホスト別レート（全サイトが 127.0.0.1 のため既定は実質無制限）")
+    parser.add_argument("--recipients", type=int, default=50, help="通知先アドレス数")
+    parser.add_argument("--emails", type=int, default=200, help="AsyncEmailService で直接送るメール数（0で省略）")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="通知送信完了の最大待ち時間（秒）")
+    parser.add_argument("--no-snapshots", action="store_true", help="スナップショット保存を無効化")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力")
+    args = parser.parse_args()
+
+    farm = SiteFarm(args.latency, args.body_size, args.change_rate, args.error_rate, not args.no_etag)
+    sent_counter = multiprocessing.Value("i", 0)
+    _, farm_port = start_server_process(farm)
+    _, smtp_port = start_server_process(SMTPSink(sent_counter))
+
+    # app 読み込み前に環境変数で設定（DB・ログは一時ディレクトリへ）
+    work_dir = tempfile.mkdtemp(prefix="watcher-bench-")
+    os.environ.update({
+        "DATA_DIR": work_dir,
+        "MAX_CONCURRENT_CHECKS": str(args.concurrency),
+        "HOST_RATE_PER_SECOND": str(args.host_rate),
+        "HOST_BURST": str(max(2, int(args.host_rate))),
+        "MIN_CHECK_INTERVAL": str(min(args.interval, 60)),
+        "SNAPSHOTS_ENABLED": "false" if args.no_snapshots else "true",
+        "SMTP_SERVER": "127.0.0.1",
+        "SMTP_PORT": str(smtp_port),
+        "SMTP_STARTTLS": "false",
+        "SMTP_USERNAME": "bench",
+        "SMTP_PASSWORD": "bench",
+        "FROM_EMAIL": "bench@bench.local"
+    })
+    os.chdir(work_dir)
+    sys.path.insert(0, app_dir)
+    import app
+    app.logger.setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    result = asyncio.run(run_benchmark(app, args, farm_port, sent_counter))
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        print(f"📁 作業ディレクトリ: {work_dir}")
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
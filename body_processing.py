@@ -0,0 +1,243 @@
+"""本文のチャンク分割と表示テキストの SimHash
+
+プロセスプールのワーカー（spawn）はこのモジュールだけを import する。
+app.py のようにログ・DB・FastAPI を初期化しないよう、import 時の副作用を持たせないこと。
+"""
+import codecs
+import hashlib
+import random
+import re
+from collections import Counter
+from html.parser import HTMLParser
+from typing import List, Optional, Tuple
+
+BODY_READ_SIZE = 64 * 1024  # 一時ファイルから読む単位
+
+SIMHASH_BITS = 64
+
+# 表示されないため常に読み飛ばす要素
+HIDDEN_TAGS = frozenset({'script', 'style', 'noscript', 'template', 'svg'})
+# 終了タグを持たない要素
+VOID_TAGS = frozenset({'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+                       'source', 'track', 'wbr'})
+
+def parse_ignore_selectors(selectors: Optional[str]) -> List[Tuple[Optional[str], Optional[str], frozenset]]:
+    """除外セレクタ（カンマ区切り）を (タグ, id, クラス集合) に分解
+
+    対応するのは tag / #id / .class とその組み合わせ（div.ad, span#clock など）のみ。
+    子孫・子結合子や属性セレクタは ValueError。
+    """
+    parsed = []
+    for selector in (selectors or '').split(','):
+        selector = selector.strip()
+        if not selector:
+            continue
+        if not re.fullmatch(r'[\w-]*(?:[.#][\w-]+)*', selector):
+            raise ValueError(f"未対応の除外セレクタです: {selector}")
+        tag = re.match(r'[\w-]*', selector).group().lower() or None
+        ids = re.findall(r'#([\w-]+)', selector)
+        if len(ids) > 1:
+            raise ValueError(f"未対応の除外セレクタです: {selector}")
+        classes = frozenset(re.findall(r'\.([\w-]+)', selector))
+        parsed.append((tag, ids[0] if ids else None, classes))
+    return parsed
+
+class VisibleTextExtractor(HTMLParser):
+    """HTMLから表示テキストだけを取り出す（script/style と除外セレクタに一致する要素の中身は読み飛ばす）"""
+
+    def __init__(self, selectors: List[Tuple[Optional[str], Optional[str], frozenset]]):
+        super().__init__(convert_charrefs=True)
+        self.selectors = selectors
+        self.parts: List[str] = []
+        self._skip_tag: Optional[str] = None
+        self._skip_depth = 0
+
+    def _matches(self, tag: str, attrs) -> bool:
+        if not self.selectors:
+            return False
+        attrs = dict(attrs)
+        element_id = attrs.get('id')
+        classes = set((attrs.get('class') or '').split())
+        for selector_tag, selector_id, selector_classes in self.selectors:
+            if ((selector_tag is None or selector_tag == tag)
+                    and (selector_id is None or selector_id == element_id)
+                    and selector_classes <= classes):
+                return True
+        return False
+
+    def handle_starttag(self, tag, attrs):
+        if self._skip_tag:
+            # 同名タグの入れ子を数えて、対応する終了タグで読み飛ばしを終える
+            if tag == self._skip_tag:
+                self._skip_depth += 1
+            return
+        if tag not in VOID_TAGS and (tag in HIDDEN_TAGS or self._matches(tag, attrs)):
+            self._skip_tag = tag
+            self._skip_depth = 1
+        else:
+            self.parts.append(' ')  # 要素の境界で語を区切る（テキストはチャンク境界で分割されて届く）
+
+    def handle_startendtag(self, tag, attrs):
+        if not self._skip_tag:
+            self.parts.append(' ')  # <br/> など。中身を持たないので読み飛ばしは始めない
+
+    def handle_endtag(self, tag):
+        if self._skip_tag == tag:
+            self._skip_depth -= 1
+            if not self._skip_depth:
+                self._skip_tag = None
+        elif not self._skip_tag:
+            self.parts.append(' ')
+
+    def handle_data(self, data):
+        if not self._skip_tag:
+            self.parts.append(data)
+
+def text_features(text: str) -> Counter:
+    """SimHash の特徴量（連続する2語のシングル）を出現回数付きで返す
+
+    空白で区切られない日本語などは文字2-gramを語として扱う。
+    """
+    tokens = []
+    for word in re.findall(r'\w+', text.lower()):
+        if len(word) > 2 and not word.isascii():
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    if len(tokens) < 2:
+        return Counter(tokens)
+    return Counter(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+
+def simhash(features: Counter) -> int:
+    """64ビット SimHash（似た文書ほどビットの差が小さくなる）"""
+    weights = [0] * SIMHASH_BITS
+    for feature, count in features.items():
+        value = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'big')
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += count if value >> bit & 1 else -count
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+def simhash_distance(a: str, b: str) -> int:
+    """16進表記の SimHash 同士のハミング距離"""
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+class TextFingerprinter:
+    """本文をチャンク単位で受け取り、表示テキストの SimHash を計算"""
+
+    def __init__(self, ignore_pattern: Optional[str] = None, ignore_selectors: Optional[str] = None):
+        self.ignore_pattern = ignore_pattern
+        self.ignore_selectors = ignore_selectors
+        self.selectors = parse_ignore_selectors(ignore_selectors)
+        self.encoding: Optional[str] = None
+        self.reset()
+
+    def reset(self):
+        """取り込み済みの内容を破棄（リトライ時）"""
+        self.parser = VisibleTextExtractor(self.selectors)
+        self._decoder = None
+        self.fingerprint: Optional[str] = None
+
+    def feed(self, data: bytes):
+        if self._decoder is None:
+            try:
+                self._decoder = codecs.getincrementaldecoder(self.encoding or 'utf-8')(errors='replace')
+            except LookupError:
+                self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.parser.feed(self._decoder.decode(data))
+
+    def finish(self) -> str:
+        if self._decoder:
+            self.parser.feed(self._decoder.decode(b'', final=True))
+        self.parser.close()
+        text = ''.join(self.parser.parts)
+        if self.ignore_pattern:
+            text = re.sub(self.ignore_pattern, ' ', text)
+        self.fingerprint = format(simhash(text_features(text)), f'0{SIMHASH_BITS // 4}x')
+        return self.fingerprint
+
+# Gear ハッシュ用の固定乱数テーブル（再起動後も同じ分割になるよう固定シード）
+_gear_random = random.Random(0x5EED)
+GEAR_TABLE = [_gear_random.getrandbits(64) for _ in range(256)]
+GEAR_MASK64 = (1 << 64) - 1
+
+class ContentDefinedChunker:
+    """Gear ローリングハッシュによる内容定義チャンク分割
+
+    ハッシュ値の上位ビットが0になる位置で区切るため、ページの一部が
+    変わっても変更箇所以外のチャンク境界は変わらない。
+    """
+    
+    def __init__(self, min_size: int = 2048, avg_size: int = 8192, max_size: int = 65536):
+        self.min_size = min_size
+        self.max_size = max_size
+        bits = avg_size.bit_length() - 1
+        self.mask = ((1 << bits) - 1) << (64 - bits)
+        self._buf = bytearray()
+        self._pos = 0  # 次回走査を再開する位置
+        self._hash = 0
+    
+    def feed(self, data: bytes) -> List[bytes]:
+        """データを追加し、確定したチャンクを返す"""
+        self._buf += data
+        buf = self._buf
+        n = len(buf)
+        chunks = []
+        start = 0
+        pos = self._pos
+        h = self._hash
+        
+        while True:
+            end = min(n, start + self.max_size)
+            i = max(pos, start + self.min_size)
+            cut = -1
+            while i < end:
+                h = ((h << 1) + GEAR_TABLE[buf[i]]) & GEAR_MASK64
+                i += 1
+                if not h & self.mask:
+                    cut = i
+                    break
+            if cut < 0 and end - start >= self.max_size:
+                cut = end
+            if cut < 0:
+                pos = i
+                break
+            chunks.append(bytes(buf[start:cut]))
+            start = pos = cut
+            h = 0
+        
+        del self._buf[:start]
+        self._pos = pos - start
+        self._hash = h
+        return chunks
+    
+    def finish(self) -> List[bytes]:
+        """残りのデータを最終チャンクとして返す"""
+        tail = bytes(self._buf)
+        self._buf = bytearray()
+        self._pos = 0
+        self._hash = 0
+        return [tail] if tail else []
+
+def process_body(path: str, chunking: bool, fingerprinting: bool, encoding: Optional[str],
+                 ignore_pattern: Optional[str], ignore_selectors: Optional[str]) -> Tuple[Optional[List[int]], Optional[str]]:
+    """一時ファイルに保存した本文のチャンク分割と表示テキストの SimHash（プロセスプールで実行）
+
+    戻り値は (チャンク長のリスト, SimHash)。チャンクそのものは親プロセスで本文から切り出す。
+    """
+    chunker = ContentDefinedChunker() if chunking else None
+    fingerprinter = TextFingerprinter(ignore_pattern, ignore_selectors) if fingerprinting else None
+    if fingerprinter:
+        fingerprinter.encoding = encoding
+    lengths = []
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(BODY_READ_SIZE)
+            if not data:
+                break
+            if chunker:
+                lengths.extend(len(chunk) for chunk in chunker.feed(data))
+            if fingerprinter:
+                fingerprinter.feed(data)
+    if chunker:
+        lengths.extend(len(chunk) for chunk in chunker.finish())
+    return (lengths if chunker else None), (fingerprinter.finish() if fingerprinter else None)
@@ -0,0 +1,39 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+def test_digest_window_starts_at_oldest_pending(monkeypatch, tmp_path):
+    """期間内に届いた通知は最初の通知の期限で1通にまとめて送る"""
+    clock = [1_000_000.0]
+    monkeypatch.setattr(app.time, "time", lambda: clock[0])
+    monkeypatch.setattr(app, "EMAIL_DIGEST_WINDOW", 3)
+
+    sent = []
+    async def send_email(to_email, subject, body):
+        sent.append((to_email, subject, body))
+        return True
+    monkeypatch.setattr(app.email_service, "send_email", send_email)
+
+    outbox = app.NotificationOutbox(app.SiteStorage(str(tmp_path / "sites.db")))
+    for i in range(3):
+        outbox.enqueue(f"https://example.com/{i}", "user@example.com", f"件名{i}", f"本文{i}")
+        clock[0] += 0.5
+
+    assert outbox._claim() == []
+
+    clock[0] = 1_000_000.0 + 3
+    rows = outbox._claim()
+    assert len(rows) == 3
+    asyncio.run(outbox._deliver(rows))
+
+    assert len(sent) == 1
+    assert sent[0][0] == "user@example.com"
+    assert outbox._claim() == []
+    assert outbox.stats() == {"pending": 0, "dead": 0}